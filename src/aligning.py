@@ -0,0 +1,197 @@
+# vim: set foldmethod=marker:
+# vim: set foldclose=all foldlevel=0:
+# vim: set foldenable:
+
+from typing import List, Optional
+import concurrent.futures
+import threading
+import time
+
+import fasta as fs
+import resources as rs
+
+def predict_cost( #{{{
+    cluster: fs.Fasta
+) -> float:
+    """
+    Predict the relative cost of aligning a cluster with clustalo.
+    The full distance matrix grows with members² x length and the progressive alignment with members x length², which both follow from the member count and the total residue length.
+    Args:
+        cluster (Fasta): The unaligned cluster.
+    Returns:
+        float: The cost in arbitrary units (comparable between clusters only).
+    """
+    members = len(cluster)
+    if members == 0:
+        return 0.0
+    residues = sum(cluster.lengths())
+    return residues * (members + residues / members)
+#}}}
+
+class CpuBudget: #{{{
+    size: int
+
+    def __init__( #{{{
+        self,
+        size: int
+    ) -> None:
+        """
+        Create a CpuBudget object, a first come first served counter of the CPUs in use.
+        Jobs are served in the order they ask, so a large job waiting for several CPUs is not overtaken by small ones.
+        Args:
+            size (int): The number of CPUs to hand out.
+        Returns:
+            None
+        """
+        self.size = size
+        self._free = size
+        self._next_ticket = 0
+        self._serving = 0
+        self._condition = threading.Condition()
+    #}}}
+
+    def acquire( #{{{
+        self,
+        cpus: int
+    ) -> None:
+        """
+        Wait for <cpus> CPUs (at most the whole budget) and take them.
+        Args:
+            cpus (int): The number of CPUs needed.
+        Returns:
+            None
+        """
+        cpus = min(cpus, self.size)
+        with self._condition:
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            self._condition.wait_for(lambda: self._serving == ticket and self._free >= cpus)
+            self._free -= cpus
+            self._serving += 1
+            self._condition.notify_all()
+    #}}}
+
+    def release( #{{{
+        self,
+        cpus: int
+    ) -> None:
+        with self._condition:
+            self._free += min(cpus, self.size)
+            self._condition.notify_all()
+    #}}}
+#}}}
+
+def plan_threads( #{{{
+    clusters: List[fs.Fasta],
+    costs: List[float],
+    workers: int,
+    threads: int,
+    large_size: int = 1000
+) -> List[int]:
+    """
+    Decide how many threads each clustalo job gets.
+    Jobs that are large (by members) or would take longer than an even share of the whole stage get <threads>, everything else runs single-core.
+    Args:
+        clusters (List[Fasta]): The clusters to align.
+        costs (List[float]): Their predicted costs (see <predict_cost>).
+        workers (int): The number of jobs running at once.
+        threads (int): The number of threads for large jobs.
+        large_size (int): The minimal number of members of a cluster to count as large. Defaults to 1000.
+    Returns:
+        List[int]: The number of threads per cluster, in input order.
+    """
+    share = sum(costs) / max(workers, 1)
+    return [
+        threads if len(cluster) >= large_size or (len(costs) > 1 and cost > share) else 1
+        for cluster, cost in zip(clusters, costs)
+    ]
+#}}}
+
+def clustalo_clusters( #{{{
+    clusters: List[fs.Fasta],
+    workers: Optional[int] = None,
+    threads: Optional[int] = None,
+    large_size: int = 1000,
+    cpus: Optional[int] = None,
+    timing: bool = False,
+    distance: str = "clustalo"
+) -> List[fs.Fasta]:
+    """
+    Align many clusters with clustalo (see Fasta.clustalo) in parallel.
+    Every cluster runs as its own clustalo process with its own job directory, so a pool of threads is enough to keep all workers busy.
+    Jobs are started longest predicted first (see <predict_cost>), so the few huge clusters do not end up alone at the tail.
+    Large jobs get several threads (see <plan_threads>) and count that many CPUs against the budget.
+    Args:
+        clusters (List[Fasta]): The clusters to align.
+        workers (int): The maximal number of clustalo processes to run at once. Defaults to <cpus>.
+        threads (int): The number of clustalo threads for large clusters. Defaults to <cpus>, but at most 8.
+        large_size (int): The minimal number of members of a cluster to count as large. Defaults to 1000.
+        cpus (int): The CPU budget of the stage. Detected from the CPU limits if omitted.
+        timing (bool): Whether to print the predicted against the actual cost of the jobs. Defaults to False.
+        distance (str): Where the distance matrices come from (see Fasta.clustalo). Defaults to 'clustalo'.
+    Returns:
+        List[Fasta]: The aligned clusters with distance matrices, in input order.
+    """
+    cpus = cpus or rs.detect_cpus()
+    workers = workers or cpus
+    threads = threads or min(cpus, 8)
+    costs = [predict_cost(cluster) for cluster in clusters]
+    plan = plan_threads(clusters, costs, workers, threads, large_size)
+    order = sorted(range(len(clusters)), key=lambda index: costs[index], reverse=True)
+    budget = CpuBudget(max(cpus, threads))
+    results = [None] * len(clusters)
+    seconds = [0.0] * len(clusters)
+
+    def align(index: int) -> None:
+        budget.acquire(plan[index])
+        try:
+            start = time.time()
+            results[index] = clusters[index].clustalo(threads=plan[index] if plan[index] > 1 else None, distance=distance)
+            seconds[index] = time.time() - start
+        finally:
+            budget.release(plan[index])
+
+    start = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for future in [executor.submit(align, index) for index in order]:
+            future.result()
+    if timing:
+        report_schedule(clusters, costs, plan, seconds, time.time() - start, budget.size)
+    return results
+#}}}
+
+def report_schedule( #{{{
+    clusters: List[fs.Fasta],
+    costs: List[float],
+    plan: List[int],
+    seconds: List[float],
+    wall_time: float,
+    cpus: int,
+    top: int = 5
+) -> None:
+    """
+    Print how well the cost model predicted the clustalo jobs.
+    Predicted costs are converted to seconds with the rate of the whole stage (actual CPU seconds per cost unit).
+    Args:
+        clusters (List[Fasta]): The aligned clusters.
+        costs (List[float]): Their predicted costs.
+        plan (List[int]): Their number of threads.
+        seconds (List[float]): Their actual run times.
+        wall_time (float): The run time of the whole stage.
+        cpus (int): The CPU budget of the stage.
+        top (int): The number of most expensive jobs to list. Defaults to 5.
+    Returns:
+        None
+    """
+    if not clusters:
+        return
+    busy = sum(duration * threads for duration, threads in zip(seconds, plan))
+    rate = busy / sum(costs) if sum(costs) else 0.0
+    print(f"Alignment schedule: {len(clusters)} jobs, {sum(threads > 1 for threads in plan)} multithreaded, {cpus} CPUs")
+    print(f"Alignment took {wall_time:.4f}s for {busy:.4f} CPU seconds (lower bound {busy / cpus:.4f}s)")
+    for index in sorted(range(len(clusters)), key=lambda index: costs[index], reverse=True)[:top]:
+        print(
+            f"  {len(clusters[index])} members, {plan[index]} threads: "
+            f"predicted {costs[index] * rate / plan[index]:.4f}s, actual {seconds[index]:.4f}s"
+        )
+#}}}
@@ -0,0 +1,255 @@
+# vim: set foldmethod=marker:
+# vim: set foldclose=all foldlevel=0:
+# vim: set foldenable:
+
+from __future__ import annotations
+from typing import List, Optional, Union
+
+import numpy as np
+
+import fasta as fs
+
+GAP = ord("-")
+DISTANCES = ["p", "poisson", "kimura"]
+# the largest distance per model: p cannot exceed 1, the corrections diverge (Poisson at p = 1, Kimura at p = 0.854)
+# and count as saturated once the argument of their logarithm falls below 1%
+SATURATION = {"p": 1.0, "poisson": float(np.log(100)), "kimura": float(np.log(100))}
+
+class Alignment: #{{{
+    matrix: np.ndarray
+    headers: List[str]
+
+    def __init__( #{{{
+        self,
+        matrix: np.ndarray,
+        headers: Optional[List[str]] = None
+    ) -> None:
+        """
+        Create an Alignment object, a multiple sequence alignment stored as 2-D uint8 array (one row per sequence, one column per position).
+        All statistics are vectorised over the whole array.
+        Args:
+            matrix (np.ndarray): The aligned residues as ASCII codes, shape (sequences, columns).
+            headers (List[str]): The headers of the sequences. Omitting numbers them.
+        Returns:
+            None
+        Raises:
+            ValueError: If <matrix> is not 2-D or does not match <headers>.
+        """
+        matrix = np.asarray(matrix, dtype=np.uint8)
+        if matrix.ndim != 2:
+            raise ValueError("The alignment matrix must be 2-D (sequences x columns).")
+        if headers is None:
+            headers = [f">{index}" for index in range(matrix.shape[0])]
+        if len(headers) != matrix.shape[0]:
+            raise ValueError("The number of headers must match the number of rows.")
+        self.matrix = matrix
+        self.headers = headers
+        self._gaps = None
+    #}}}
+
+    @classmethod
+    def from_fasta( #{{{
+        cls,
+        fasta: fs.Fasta
+    ) -> Alignment:
+        """
+        Create an Alignment object from an aligned Fasta object (e.g. the result of Fasta.clustalo).
+        Args:
+            fasta (Fasta): The aligned sequences. All must have the same length.
+        Returns:
+            Alignment: The alignment.
+        Raises:
+            ValueError: If the sequences differ in length.
+        """
+        store = fasta.store
+        rows = np.frombuffer(fasta.rows, dtype=np.int64)
+        if len(rows) == 0:
+            return cls(np.zeros((0, 0), dtype=np.uint8), [])
+        starts = np.frombuffer(store.residue_start, dtype=np.int64)[rows]
+        lengths = np.frombuffer(store.residue_end, dtype=np.int64)[rows] - starts
+        if np.any(lengths != lengths[0]):
+            raise ValueError("The sequences are not aligned (they differ in length).")
+        # gathering copies, so the store can grow again once <residues> is released
+        residues = np.frombuffer(store.residues, dtype=np.uint8)
+        matrix = residues[starts[:, None] + np.arange(lengths[0])]
+        del residues
+        return cls(matrix, fasta.headers())
+    #}}}
+
+    def to_fasta( #{{{
+        self
+    ) -> fs.Fasta:
+        """
+        Turn the alignment back into a Fasta object.
+        Args:
+            None
+        Returns:
+            Fasta: The aligned sequences.
+        """
+        result = fs.Fasta()
+        for header, row in zip(self.headers, self.matrix):
+            result.rows.append(result.store.append(header, row.tobytes()))
+        return result
+    #}}}
+
+    def __len__( #{{{
+        self
+    ) -> int:
+        return self.matrix.shape[0]
+    #}}}
+
+    @property
+    def width( #{{{
+        self
+    ) -> int:
+        return self.matrix.shape[1]
+    #}}}
+
+    @property
+    def gaps( #{{{
+        self
+    ) -> np.ndarray:
+        """
+        The gap mask, True where the alignment has a gap. Calculated once.
+        """
+        if self._gaps is None:
+            self._gaps = self.matrix == GAP
+        return self._gaps
+    #}}}
+
+    def gap_count( #{{{
+        self,
+        axis: Optional[str] = None
+    ) -> Union[int, np.ndarray]:
+        """
+        Count the gaps.
+        Args:
+            axis (str): 'sequence' for one count per sequence, 'column' for one per column. Omitting counts the whole alignment.
+        Returns:
+            int or np.ndarray: The gap count(s).
+        """
+        if axis is None:
+            return int(self.gaps.sum())
+        return self.gaps.sum(axis=self._axis(axis))
+    #}}}
+
+    def gap_fraction( #{{{
+        self,
+        axis: Optional[str] = None
+    ) -> Union[float, np.ndarray]:
+        """
+        Calculate the fraction of gaps.
+        Args:
+            axis (str): 'sequence' for one fraction per sequence, 'column' for one per column. Omitting uses the whole alignment.
+        Returns:
+            float or np.ndarray: The gap fraction(s), 0 for an empty alignment.
+        """
+        if self.matrix.size == 0:
+            return 0.0 if axis is None else np.zeros(self.matrix.shape[1 - self._axis(axis)])
+        if axis is None:
+            return float(self.gaps.mean())
+        return self.gaps.mean(axis=self._axis(axis))
+    #}}}
+
+    def occupancy( #{{{
+        self
+    ) -> np.ndarray:
+        """
+        Calculate the fraction of sequences with a residue (no gap) per column.
+        Args:
+            None
+        Returns:
+            np.ndarray: One value per column.
+        """
+        return 1 - self.gap_fraction(axis="column")
+    #}}}
+
+    def conservation( #{{{
+        self
+    ) -> np.ndarray:
+        """
+        Calculate the frequency of the most common residue among the non-gap residues per column.
+        Args:
+            None
+        Returns:
+            np.ndarray: One value per column, 0 for columns containing only gaps.
+        """
+        width = self.matrix.shape[1]
+        if width == 0:
+            return np.zeros(0)
+        # one histogram of the 256 byte values per column in a single bincount
+        codes = self.matrix.astype(np.int64) + 256 * np.arange(width)
+        counts = np.bincount(codes.ravel(), minlength=256 * width).reshape(width, 256)
+        counts[:, GAP] = 0
+        residues = counts.sum(axis=1)
+        return np.divide(counts.max(axis=1), residues, out=np.zeros(width), where=residues > 0)
+    #}}}
+
+    def trim( #{{{
+        self,
+        max_gap: float
+    ) -> Alignment:
+        """
+        Remove gappy columns.
+        Args:
+            max_gap (float): The maximal gap fraction of a column to keep.
+        Returns:
+            Alignment: A new alignment with the remaining columns.
+        """
+        return Alignment(self.matrix[:, self.gap_fraction(axis="column") <= max_gap], self.headers)
+    #}}}
+
+    def distances( #{{{
+        self,
+        model: str = "p",
+        max_distance: Optional[float] = None
+    ) -> np.ndarray:
+        """
+        Calculate the distances between all pairs of sequences with pairwise deletion (only columns where both have a residue count).
+        All pairs are compared at once: with one-hot masks M_c per residue and the residue mask G, the matches are the sum of M_c M_c^T and the compared columns G G^T.
+        Args:
+            model (str): 'p' for the p-distance (fraction of differing residues), 'poisson' for the Poisson correction -ln(1-p) or 'kimura' for Kimura's protein correction -ln(1-p-0.2p²). Defaults to 'p'.
+            max_distance (float): The largest distance, given to pairs beyond the saturation of the correction and to pairs without shared columns (e.g. non-overlapping fragments). Defaults to the limit of the model (see SATURATION).
+        Returns:
+            np.ndarray: The symmetric distance matrix (sequences x sequences) with zeros on the diagonal.
+        Raises:
+            ValueError: If <model> is unknown.
+        """
+        if model not in DISTANCES:
+            raise ValueError(f"Valid distance models: {', '.join(DISTANCES)} (provided: {model})")
+        residues = ~self.gaps
+        mask = residues.astype(np.float32)
+        # float32 counts are exact up to 2^24 columns and let BLAS do the work
+        compared = mask @ mask.T
+        matches = np.zeros_like(compared)
+        for code in np.unique(self.matrix[residues]):
+            mask = (self.matrix == code).astype(np.float32)
+            matches += mask @ mask.T
+        compared, matches = compared.astype(np.float64), matches.astype(np.float64)
+        shared = compared > 0
+        limit = SATURATION[model] if max_distance is None else max_distance
+        p = np.ones(compared.shape)
+        np.divide(compared - matches, compared, out=p, where=shared)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            if model == "p":
+                result = p
+            elif model == "poisson":
+                result = np.log(1 / (1 - p))
+            else:
+                result = np.log(1 / (1 - p - 0.2 * p**2))
+        result = np.where(shared & np.isfinite(result), np.minimum(result, limit), limit)
+        np.fill_diagonal(result, 0.0)
+        return result
+    #}}}
+
+    def _axis( #{{{
+        _,
+        axis: str
+    ) -> int:
+        if axis == "sequence":
+            return 1
+        if axis == "column":
+            return 0
+        raise ValueError(f"Valid axes: sequence, column (provided: {axis})")
+    #}}}
+#}}}
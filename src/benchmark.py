@@ -0,0 +1,302 @@
+# vim: set foldmethod=marker:
+# vim: set foldclose=all foldlevel=0:
+# vim: set foldenable:
+
+from typing import List, Set, Tuple
+import argparse
+import random
+import time
+
+import numpy as np
+
+import clustering as cl
+import fasta as fs
+import tree as tr
+
+def random_links( #{{{
+    links: int,
+    proteins: int,
+    seed: int = 0
+) -> List[Set[str]]:
+    """
+    Create random pair links in the shape returned by clustering.diamond.
+    Args:
+        links (int): The number of links to create.
+        proteins (int): The number of distinct protein identifiers to draw from.
+        seed (int): The seed for the random number generator. Defaults to 0.
+    Returns:
+        List[Set[str]]: A list of sets, each containing two protein identifiers.
+    """
+    rng = random.Random(seed)
+    names = [f"bin{index % 500}-X_{index:08}" for index in range(proteins)]
+    return [{names[rng.randrange(proteins)], names[rng.randrange(proteins)]} for _ in range(links)]
+#}}}
+
+def grow_clusters_naive( #{{{
+    clusters: List[Set[str]]
+) -> List[Set[str]]:
+    """
+    The original quadratic merging loop, kept as a reference for the benchmark.
+    Args:
+        clusters (List[Set[str]]): A list containing sets with identifier strings.
+    Returns:
+        List[Set[str]]: The resulting list of disjoint sets.
+    """
+    while True:
+        new_clusters = []
+        merged = False
+        while clusters:
+            seed = clusters.pop(0)
+            for cluster in clusters:
+                if not seed.isdisjoint(cluster):
+                    seed = seed.union(cluster)
+                    clusters.remove(cluster)
+                    merged = True
+            new_clusters.append(seed)
+        clusters = new_clusters
+        if not merged:
+            break
+    return clusters
+#}}}
+
+def bench_grow_clusters( #{{{
+    sizes: List[int],
+    naive_limit: int = 10_000
+) -> List[Tuple[int, float, float]]:
+    """
+    Time clustering.grow_clusters for different numbers of links.
+    Every protein is linked about twice on average, similar to DIAMOND cluster output.
+    Args:
+        sizes (List[int]): The numbers of links to benchmark.
+        naive_limit (int): Up to this many links the naive algorithm is timed and compared as well. Defaults to 10000.
+    Returns:
+        List[Tuple[int, float, float]]: (links, union-find seconds, naive seconds or nan) per size.
+    """
+    results = []
+    for size in sizes:
+        links = random_links(size, proteins=size)
+        start_time = time.time()
+        clusters = cl.grow_clusters(links)
+        fast = time.time() - start_time
+        naive = float("nan")
+        if size <= naive_limit:
+            start_time = time.time()
+            reference = grow_clusters_naive([set(link) for link in links])
+            naive = time.time() - start_time
+            if sorted(map(sorted, clusters)) != sorted(map(sorted, reference)):
+                raise ValueError(f"grow_clusters differs from the reference for {size} links")
+        print(f"{size:>10} links: union-find {fast:.4f}s, naive {naive:.4f}s ({len(clusters)} clusters)")
+        results.append((size, fast, naive))
+    return results
+#}}}
+
+def random_distmat( #{{{
+    size: int,
+    seed: int = 0
+) -> fs.Distmat:
+    """
+    Create a Distmat with uniformly random distances (no ties).
+    Args:
+        size (int): The number of elements.
+        seed (int): The seed for the random number generator. Defaults to 0.
+    Returns:
+        Distmat: The distance matrix.
+    """
+    rng = np.random.default_rng(seed)
+    return fs.Distmat.from_condensed(rng.random(size * (size - 1) // 2), labels=[f"X_{index}" for index in range(size)])
+#}}}
+
+def upgma_naive( #{{{
+    matrix: List[List[float]],
+    labels: List[str]
+) -> str:
+    """
+    The original cubic loop (global search for the closest pair, then rebuilding the matrix), kept as a reference for the benchmark.
+    Args:
+        matrix (List[List[float]]): The square distance matrix. Modified in place.
+        labels (List[str]): The labels. Modified in place.
+    Returns:
+        str: The tree in Newick format without distances.
+    """
+    while len(labels) > 1:
+        a, b, current_min = -1, -1, float("inf")
+        for i, row in enumerate(matrix):
+            for j, col in enumerate(row):
+                if col < current_min and i != j:
+                    a, b, current_min = i, j, col
+        if b < a:
+            a, b = b, a
+        labels.append(f"({labels[a]},{labels[b]})")
+        del labels[b]
+        del labels[a]
+        new_dists = [(x + y) / 2 for x, y in zip(matrix[a], matrix[b])] + [0.0]
+        matrix.append(new_dists[:-1])
+        for i in range(len(matrix)):
+            matrix[i].append(new_dists[i])
+        for row in matrix:
+            del row[b]
+            del row[a]
+        del matrix[b]
+        del matrix[a]
+    return labels[0]
+#}}}
+
+def bench_upgma( #{{{
+    sizes: List[int],
+    naive_limit: int = 300
+) -> List[Tuple[int, float, float]]:
+    """
+    Time Distmat.upgma (nearest-neighbour chain) for different numbers of sequences.
+    Args:
+        sizes (List[int]): The matrix sizes to benchmark.
+        naive_limit (int): Up to this size the naive algorithm is timed and compared as well. Defaults to 300.
+    Returns:
+        List[Tuple[int, float, float]]: (size, chain seconds, naive seconds or nan) per size.
+    """
+    results = []
+    for size in sizes:
+        distmat = random_distmat(size)
+        start_time = time.time()
+        tree = distmat.upgma().newick()
+        fast = time.time() - start_time
+        naive = float("nan")
+        if size <= naive_limit:
+            start_time = time.time()
+            reference = upgma_naive(distmat.matrix.tolist(), distmat.labels[:])
+            naive = time.time() - start_time
+            if tree != reference:
+                raise ValueError(f"upgma differs from the reference for {size} sequences")
+        print(f"{size:>10} sequences: nn-chain {fast:.4f}s, naive {naive:.4f}s")
+        results.append((size, fast, naive))
+        del distmat
+    return results
+#}}}
+
+def nj_naive( #{{{
+    distmat: fs.Distmat
+) -> tr.Tree:
+    """
+    Neighbour joining with a full search of the Q-matrix in every step, kept as a reference for the benchmark.
+    Args:
+        distmat (Distmat): The distance matrix.
+    Returns:
+        Tree: The tree (without branch lengths).
+    """
+    size = distmat.size
+    parent = np.full(size + max(size - 2, 1), -1)
+    matrix = distmat.matrix.astype(np.float64)
+    slots = np.arange(size)
+    created = size
+    active = size
+    while active > 3:
+        block = matrix[:active, :active]
+        sums = block.sum(axis=1)
+        q = (active - 2) * block - sums[:, None] - sums[None, :]
+        np.fill_diagonal(q, np.inf)
+        i, j = sorted(divmod(int(np.argmin(q)), active))
+        parent[[slots[i], slots[j]]] = created
+        joined = (block[i] + block[j] - block[i, j]) / 2
+        joined[i] = 0.0
+        matrix[i, :active] = joined
+        matrix[:active, i] = joined
+        slots[i] = created
+        created += 1
+        last = active - 1
+        if j != last:
+            matrix[j, :active] = matrix[last, :active]
+            matrix[:active, j] = matrix[:active, last]
+            matrix[j, j] = 0.0
+            slots[j] = slots[last]
+        active -= 1
+    parent[slots[:active]] = created
+    return tr.Tree(distmat.labels[:], parent, np.zeros(len(parent)))
+#}}}
+
+def cluster_sizes( #{{{
+    clusters: int,
+    largest: int = 2000,
+    seed: int = 0
+) -> List[int]:
+    """
+    Draw cluster sizes from a heavy-tailed (Zipf) distribution like the one of gene clusters: mostly a few members, some with thousands.
+    Args:
+        clusters (int): The number of clusters.
+        largest (int): The largest possible cluster. Defaults to 2000.
+        seed (int): The seed for the random number generator. Defaults to 0.
+    Returns:
+        List[int]: The cluster sizes, at least 3 (the default size threshold of the pipeline).
+    """
+    rng = np.random.default_rng(seed)
+    return np.minimum(2 + rng.zipf(1.6, clusters), largest).tolist()
+#}}}
+
+def bench_nj( #{{{
+    sizes: List[int],
+    clusters: int = 2000,
+    naive_limit: int = 1000
+) -> List[Tuple[int, float, float, float]]:
+    """
+    Time Distmat.nj against Distmat.upgma, first for different numbers of sequences, then for a whole set of clusters (see <cluster_sizes>).
+    Args:
+        sizes (List[int]): The matrix sizes to benchmark.
+        clusters (int): The number of clusters in the set. Defaults to 2000.
+        naive_limit (int): Up to this size the full Q-matrix search is timed and compared as well. Defaults to 1000.
+    Returns:
+        List[Tuple[int, float, float, float]]: (size, nj seconds, full search seconds or nan, upgma seconds) per size.
+    """
+    results = []
+    for size in sizes:
+        distmat = random_distmat(size)
+        start_time = time.time()
+        tree = distmat.nj()
+        tree.newick()
+        fast = time.time() - start_time
+        naive = float("nan")
+        if size <= naive_limit:
+            start_time = time.time()
+            reference = nj_naive(distmat)
+            naive = time.time() - start_time
+            # equal Q-values (always in the last steps) may be joined in another order, so only the unrooted topologies must match
+            if tree.splits() != reference.splits():
+                raise ValueError(f"nj differs from the reference for {size} sequences")
+        start_time = time.time()
+        distmat.upgma()
+        upgma = time.time() - start_time
+        print(f"{size:>10} sequences: nj {fast:.4f}s, full search {naive:.4f}s, upgma {upgma:.4f}s")
+        results.append((size, fast, naive, upgma))
+        del distmat
+    drawn = cluster_sizes(clusters)
+    totals = {"nj": 0.0, "upgma": 0.0}
+    for seed, size in enumerate(drawn):
+        distmat = random_distmat(size, seed)
+        for method in totals:
+            start_time = time.time()
+            distmat.tree(method=method)
+            totals[method] += time.time() - start_time
+    print(f"{clusters:>10} clusters ({sum(drawn)} sequences, largest {max(drawn)}): nj {totals['nj']:.4f}s, upgma {totals['upgma']:.4f}s")
+    return results
+#}}}
+
+if __name__ == "__main__": # {{{
+    parser = argparse.ArgumentParser(prog="benchmark.py")
+    parser.add_argument(
+        "BENCHMARK",
+        choices = ["grow", "upgma", "nj"],
+        help = "The benchmark to run"
+    )
+    parser.add_argument(
+        "--sizes",
+        metavar = "N",
+        nargs = "+",
+        help = "The problem sizes to benchmark",
+        type = int
+    )
+    args = parser.parse_args()
+
+    if args.BENCHMARK == "grow":
+        bench_grow_clusters(args.sizes or [10_000, 100_000, 1_000_000, 10_000_000])
+    elif args.BENCHMARK == "upgma":
+        bench_upgma(args.sizes or [100, 300, 1_000, 5_000, 20_000])
+    elif args.BENCHMARK == "nj":
+        bench_nj(args.sizes or [100, 300, 1_000, 3_000])
+# }}}
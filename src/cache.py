@@ -0,0 +1,165 @@
+# vim: set foldmethod=marker:
+# vim: set foldclose=all foldlevel=0:
+# vim: set foldenable:
+
+from typing import List, Set, Optional, Dict
+from array import array
+import hashlib
+import os
+
+import fasta as fs
+import tools as tl
+
+_versions: Dict[str, str] = {}
+
+def diamond_version( #{{{
+    executable: str
+) -> str:
+    """
+    Get the version string of a diamond executable (cached per executable).
+    Args:
+        executable (str): Path of the diamond executable.
+    Returns:
+        str: The output of 'diamond version', or an empty string if it could not be run.
+    """
+    if executable not in _versions:
+        try:
+            _versions[executable] = tl.run([executable, "version"], name="diamond version").decode().strip()
+        except (OSError, tl.ToolError):
+            _versions[executable] = ""
+    return _versions[executable]
+#}}}
+
+class ClusterCache: #{{{
+    path: str
+    max_size: int
+
+    SUFFIX = ".clusters"
+
+    def __init__( #{{{
+        self,
+        path: str,
+        max_size: int = 10 * 1024**3
+    ) -> None:
+        """
+        Create a ClusterCache object, an on-disk cache of grown DIAMOND clusters.
+        Entries are addressed by a hash of everything that determines the clustering (see <key>) and evicted least recently used first.
+        Args:
+            path (str): The cache directory. Created if missing.
+            max_size (int): The maximal total size of all entries in bytes. Defaults to 10 GiB.
+        Returns:
+            None
+        """
+        self.path = path
+        self.max_size = max_size
+        os.makedirs(path, exist_ok=True)
+    #}}}
+
+    def key( #{{{
+        self,
+        fasta: fs.Fasta,
+        threshold: int,
+        method: str,
+        executable: str,
+        extra_args: List[str] = []
+    ) -> str:
+        """
+        Calculate the cache key of a clustering run.
+        Args:
+            fasta (Fasta): The input Fasta object (identifiers and sequences, in order).
+            threshold (int): The identity treshold in percent.
+            method (str): Either 'cluster' or 'linclust'.
+            executable (str): Path of the diamond executable, whose version is part of the key.
+            extra_args (List[str]): Additional diamond arguments that change the result (e.g. '--fast'). Defaults to none.
+        Returns:
+            str: The hex digest identifying the run.
+        """
+        digest = hashlib.sha256()
+        digest.update(f"{threshold}\t{method}\t{diamond_version(executable)}\t{' '.join(extra_args)}\n".encode())
+        for sequence in fasta:
+            digest.update(f"{fs.header_id(sequence.header)}\n{sequence.sequence}\n".encode())
+        return digest.hexdigest()
+    #}}}
+
+    def file( #{{{
+        self,
+        key: str
+    ) -> str:
+        return os.path.join(self.path, f"{key}{self.SUFFIX}")
+    #}}}
+
+    def get( #{{{
+        self,
+        key: str
+    ) -> Optional[List[Set[int]]]:
+        """
+        Look up the clusters of a run and mark the entry as recently used.
+        Args:
+            key (str): The cache key (see <key>).
+        Returns:
+            List[Set[int]] or None: The clusters as integer IDs like clustering.grow_clusters with <size>, or None on a miss.
+        """
+        filepath = self.file(key)
+        labels = array("i")
+        try:
+            with open(filepath, "rb") as file:
+                labels.frombytes(file.read())
+            os.utime(filepath)
+        except (OSError, ValueError):
+            return None
+        clusters = {}
+        for position, label in enumerate(labels):
+            clusters.setdefault(label, set()).add(position)
+        return list(clusters.values())
+    #}}}
+
+    def put( #{{{
+        self,
+        key: str,
+        clusters: List[Set[int]]
+    ) -> None:
+        """
+        Store the clusters of a run and evict old entries if the cache grew too large.
+        Args:
+            key (str): The cache key (see <key>).
+            clusters (List[Set[int]]): Disjoint clusters covering the integer IDs 0 to n-1.
+        Returns:
+            None
+        """
+        labels = array("i", [0]) * sum(len(cluster) for cluster in clusters)
+        for label, cluster in enumerate(clusters):
+            for position in cluster:
+                labels[position] = label
+        temporary = f"{self.file(key)}.temp"
+        with open(temporary, "wb") as file:
+            labels.tofile(file)
+        os.replace(temporary, self.file(key))
+        self.evict()
+    #}}}
+
+    def evict( #{{{
+        self
+    ) -> None:
+        """
+        Remove the least recently used entries until the cache fits into <max_size>.
+        Args:
+            None
+        Returns:
+            None
+        """
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith(self.SUFFIX):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, filepath in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(filepath)
+                total -= size
+            except OSError:
+                continue
+    #}}}
+#}}}
@@ -0,0 +1,299 @@
+# vim: set foldmethod=marker:
+# vim: set foldclose=all foldlevel=0:
+# vim: set foldenable:
+
+from __future__ import annotations
+from typing import List, Set, Dict, Iterable, Optional
+import os
+import shutil
+
+import fasta as fs
+import io_helpers as io
+import workdir as wd
+import tools as tl
+
+class ClusterStore: #{{{
+    path: str
+    threshold: int
+    method: str
+    members: Dict[str, int]
+    size: int
+
+    SETTINGS = "settings.tsv"
+    MEMBERS = "members.tsv"
+    REPRESENTATIVES = "representatives.fasta"
+    STAGED = "representatives.fasta.new"
+    DATABASE = "representatives.dmnd"
+
+    def __init__( #{{{
+        self,
+        path: str,
+        threshold: int,
+        method: str = "cluster"
+    ) -> None:
+        """
+        Create an empty ClusterStore object, the persistent result of a previous clustering run.
+        A store is a directory holding the settings, the cluster of every member, the cluster representatives and their DIAMOND database.
+        Use <load> to open an existing store.
+        Args:
+            path (str): The directory of the store, made absolute as DIAMOND runs in its own job directory.
+            threshold (int): The identity threshold the clusters were built with.
+            method (str): The DIAMOND clustering method ('cluster' or 'linclust'). Defaults to 'cluster'.
+        Returns:
+            None
+        """
+        self.path = os.path.abspath(path)
+        self.threshold = threshold
+        self.method = method
+        self.members = {}
+        self.size = 0
+        self._fresh = True
+        self._staged = False
+    #}}}
+
+    def __len__( #{{{
+        self
+    ) -> int:
+        return self.size
+    #}}}
+
+    def file( #{{{
+        self,
+        filename: str
+    ) -> str:
+        return os.path.join(self.path, filename)
+    #}}}
+
+    @classmethod
+    def exists( #{{{
+        cls,
+        path: str
+    ) -> bool:
+        """
+        Check whether <path> contains a cluster store.
+        Args:
+            path (str): The directory to check.
+        Returns:
+            bool: True if a store was saved there.
+        """
+        return os.path.isfile(os.path.join(path, cls.SETTINGS))
+    #}}}
+
+    @classmethod
+    def load( #{{{
+        cls,
+        path: str
+    ) -> ClusterStore:
+        """
+        Load a cluster store saved by a previous run.
+        The number of clusters also covers the members, in case a run stopped between writing them and the settings.
+        Args:
+            path (str): The directory of the store.
+        Returns:
+            ClusterStore: The loaded store.
+        """
+        settings = dict(io.parse_csv(os.path.join(path, cls.SETTINGS), sep="\t"))
+        store = cls(path, threshold=int(settings["threshold"]), method=settings["method"])
+        for member, cluster in io.parse_csv(store.file(cls.MEMBERS), sep="\t"):
+            store.members[member] = int(cluster)
+        store.size = max([int(settings["clusters"]), *(cluster + 1 for cluster in store.members.values())])
+        store._fresh = False
+        return store
+    #}}}
+
+    def new_members( #{{{
+        self,
+        fasta: fs.Fasta
+    ) -> List[int]:
+        """
+        Find the sequences of <fasta> that are not part of the store yet.
+        Args:
+            fasta (Fasta): The current input, with an index (see Fasta.build_index).
+        Returns:
+            List[int]: The positions of the new sequences in <fasta>.
+        """
+        return [position for identifier, position in fasta.ids.items() if identifier not in self.members]
+    #}}}
+
+    def add_clusters( #{{{
+        self,
+        fasta: fs.Fasta,
+        clusters: Iterable[Iterable[int]],
+        representatives: Iterable[int]
+    ) -> None:
+        """
+        Add new clusters to the store. Call <save> afterwards to persist them.
+        The new representatives are staged next to the store and only join its representatives in <save>, so an interrupted run cannot add them twice.
+        Args:
+            fasta (Fasta): The Fasta object the positions refer to.
+            clusters (Iterable[Iterable[int]]): The new clusters as positions in <fasta>.
+            representatives (Iterable[int]): The positions of their representatives (e.g. the DIAMOND centroids). Clusters without one are represented by their first member.
+        Returns:
+            None
+        """
+        representatives = set(representatives)
+        chosen = []
+        for cluster in clusters:
+            cluster = sorted(cluster)
+            for position in cluster:
+                self.members[fs.header_id(fasta.header(position))] = self.size
+            chosen += [position for position in cluster if position in representatives] or cluster[:1]
+            self.size += 1
+        new_representatives = fasta.subset(chosen)
+        os.makedirs(self.path, exist_ok=True)
+        # the first call overwrites what an unfinished run left staged
+        with open(self.file(self.STAGED), 'a' if self._staged else 'w') as file:
+            for sequence in new_representatives:
+                file.write(f"{sequence.header}\n{sequence.sequence}\n")
+        self._staged = True
+    #}}}
+
+    def assign( #{{{
+        self,
+        fasta: fs.Fasta,
+        positions: List[int],
+        executable: str = "./diamond/diamond",
+        options: List[str] = [],
+        cover: int = 80,
+        verbose: bool = False
+    ) -> List[int]:
+        """
+        Assign new sequences to existing clusters by searching them against the representatives (the reassign step of DIAMOND's incremental workflow).
+        Sequences hitting a representative with at least the store's identity threshold join its cluster. Call <save> afterwards to persist them.
+        Args:
+            fasta (Fasta): The Fasta object the positions refer to.
+            positions (List[int]): The positions of the sequences to assign.
+            executable (str): Path of the diamond executable. Defaults to './diamond/diamond'.
+            options (List[str]): Resource and tuning arguments for diamond (see clustering.diamond_options). Defaults to none.
+            cover (int): The minimal coverage of the new sequence by the alignment in percent. Defaults to 80, like DIAMOND's --member-cover.
+            verbose (bool): Whether to allow the output of diamond on stdout. Defaults to False.
+        Returns:
+            List[int]: The positions that did not match any representative.
+        """
+        if not positions or self.size == 0:
+            return list(positions)
+        with wd.job("diamond_assign") as job:
+            fasta.subset(positions).write(job.file("new"))
+            command = [
+                executable,
+                "blastp",
+                "-q",
+                job.file("new.fasta"),
+                "-d",
+                self.file(self.DATABASE),
+                "-o",
+                job.file("hits.tsv"),
+                "--id",
+                str(self.threshold),
+                "--query-cover",
+                str(cover),
+                "--max-target-seqs",
+                "1",
+                "--outfmt",
+                "6",
+                "qseqid",
+                "sseqid",
+                "--tmpdir",
+                job.path,
+                *options
+            ]
+            tl.run(command, cwd=job.path, echo=verbose, name="diamond blastp")
+            hits = io.parse_csv(job.file("hits.tsv"), sep="\t")
+        for query, target, *_ in hits:
+            # representatives of an interrupted save are not members yet
+            if query not in self.members and target in self.members:
+                self.members[query] = self.members[target]
+        return [position for position in positions if fs.header_id(fasta.header(position)) not in self.members]
+    #}}}
+
+    def clusters( #{{{
+        self,
+        fasta: fs.Fasta
+    ) -> List[Set[int]]:
+        """
+        Return the stored clusters of all sequences in <fasta>.
+        Stored members that are not part of <fasta> (anymore) are left out.
+        Args:
+            fasta (Fasta): The current input, with an index (see Fasta.build_index).
+        Returns:
+            List[Set[int]]: The clusters as positions in <fasta>, ordered by cluster number.
+        Raises:
+            ValueError: If a sequence of <fasta> is not part of the store.
+        """
+        result = [set() for _ in range(self.size)]
+        for identifier, position in fasta.ids.items():
+            cluster = self.members.get(identifier)
+            if cluster is None:
+                raise ValueError(f"<{identifier}> is not part of the cluster store at {self.path}")
+            result[cluster].add(position)
+        return [cluster for cluster in result if cluster]
+    #}}}
+
+    def save( #{{{
+        self,
+        executable: str = "./diamond/diamond",
+        threads: Optional[int] = None,
+        verbose: bool = False
+    ) -> None:
+        """
+        Persist the store and rebuild the DIAMOND database of the representatives if they changed.
+        The representatives and their database are built next to the store first, so a failing diamond leaves the saved store untouched.
+        Only then are the files renamed into place, the members and the settings last.
+        Args:
+            executable (str): Path of the diamond executable. Defaults to './diamond/diamond'.
+            threads (int): The number of threads for diamond. Omitting lets diamond decide.
+            verbose (bool): Whether to allow the output of diamond on stdout. Defaults to False.
+        Returns:
+            None
+        Raises:
+            OSError: If a file of the store cannot be written.
+            ToolError: If diamond fails.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        replacements = []
+        if self._staged or not os.path.isfile(self.file(self.DATABASE)):
+            representatives = self.file(f"{self.REPRESENTATIVES}.temp")
+            database = self.file(f"temp.{self.DATABASE}")
+            self._merge_staged(representatives)
+            command = [
+                executable,
+                "makedb",
+                "--in",
+                representatives,
+                "-d",
+                database,
+                *(["--threads", str(threads)] if threads else [])
+            ]
+            with wd.job("diamond_makedb") as job:
+                tl.run(command, cwd=job.path, echo=verbose, name="diamond makedb")
+            replacements += [(representatives, self.file(self.REPRESENTATIVES)), (database, self.file(self.DATABASE))]
+        temporary = self.file(f"{self.MEMBERS}.temp")
+        with open(temporary, "w") as file:
+            file.writelines(f"{member}\t{cluster}\n" for member, cluster in self.members.items())
+        replacements.append((temporary, self.file(self.MEMBERS)))
+        temporary = self.file(f"{self.SETTINGS}.temp")
+        with open(temporary, "w") as file:
+            file.write(f"threshold\t{self.threshold}\nmethod\t{self.method}\nclusters\t{self.size}\n")
+        replacements.append((temporary, self.file(self.SETTINGS)))
+        for temporary, target in replacements:
+            os.replace(temporary, target)
+        if self._staged:
+            os.remove(self.file(self.STAGED))
+        self._fresh = False
+        self._staged = False
+    #}}}
+
+    def _merge_staged( #{{{
+        self,
+        target: str
+    ) -> None:
+        sources = [self.file(self.STAGED)] if self._staged else []
+        # a new store must not keep representatives left behind by an unfinished run
+        if not self._fresh:
+            sources.insert(0, self.file(self.REPRESENTATIVES))
+        with open(target, "wb") as handle:
+            for source in sources:
+                with open(source, "rb") as file:
+                    shutil.copyfileobj(file, handle)
+    #}}}
+#}}}
@@ -2,15 +2,21 @@
 # vim: set foldclose=all foldlevel=0:
 # vim: set foldenable: 
 
-from typing import List, Set, Optional
-import subprocess
-import re
+from typing import List, Set, Optional, Iterable, Iterator, Hashable, Dict, Tuple, Union
 import argparse
-import os
+import shlex
 import time
+import concurrent.futures
 
 import fasta as fs
 import io_helpers as io
+import workdir as wd
+import tools as tl
+import resources as rs
+import cluster_store as cs
+import cache as ch
+import faidx
+from disjoint_set import DisjointSet
 
 def concat_fastas( # {{{
         fastas: List[fs.Fasta],
@@ -33,16 +39,69 @@ def concat_fastas( # {{{
         for index, fasta in enumerate(fastas):
             fasta.redit(edit=(r"^>(.+)$", rf">{names[index]}{names_sep}\1"))
     [result.add(fasta) for fasta in fastas]
+    result.build_index()
     return result
 # }}}
 
+def load_fastas( # {{{
+    files: List[str],
+    names: List[str] = [],
+    names_sep: str = "-",
+    workers: Optional[int] = None,
+    processes: bool = False
+) -> fs.Fasta:
+    """
+    Read many fasta files concurrently into a single indexed Fasta object.
+    Names are prepended to the headers while parsing (like <concat_fastas>), and the files are combined in input order.
+    Args:
+        files (List[str]): The paths of the fasta files.
+        names (List[str]): A list of names to prepend to fasta headers to identify them later. Omiting will disable this feature.
+        names_sep (str): A string to separate name from header when marking fastas with names. Defaults to '-'.
+        workers (int): The number of parallel readers. Omitting uses the default of the pool.
+        processes (bool): Whether to use a process pool instead of a thread pool, for when parsing rather than I/O is the bottleneck. Defaults to False.
+    Returns:
+        Fasta: The merged Fasta object, with its index built.
+    Raises:
+        ValueError: If <names> and <files> do not match in length.
+    """
+    if len(names) != 0 and len(files) != len(names):
+        raise ValueError("names and files do not match in length!")
+    identifiers = [f"{name}{names_sep}" for name in names] if names else [""] * len(files)
+    pool = concurrent.futures.ProcessPoolExecutor if processes else concurrent.futures.ThreadPoolExecutor
+    result = fs.Fasta()
+    with pool(max_workers=workers) as executor:
+        for fasta in executor.map(_read_fasta, files, identifiers):
+            result.add(fasta)
+    result.build_index()
+    return result
+# }}}
+
+def _read_fasta( # {{{
+    file: str,
+    identifier: str
+) -> fs.Fasta:
+    fasta = fs.Fasta()
+    fasta.read(file, identifier=identifier)
+    return fasta
+# }}}
+
 def main( # {{{
     data_file: str,
     executable: str,
     threshold: int,
     method:str = "cluster",
     verbose: bool = False,
-    nopurge:bool = False
+    nopurge:bool = False,
+    cpus: Optional[int] = None,
+    memory: Optional[int] = None,
+    block_size: Optional[float] = None,
+    diamond_args: List[str] = [],
+    store: Optional[str] = None,
+    cache_dir: Optional[str] = None,
+    cache_size: int = 10 * 1024**3,
+    load_workers: Optional[int] = None,
+    load_processes: bool = False,
+    proteome: Optional[str] = None
 ):
     """
     Main entrypoint into the clustering module
@@ -53,6 +112,16 @@ def main( # {{{
         method (str): Can be either 'cluster' or 'linclust' depending on the preferred clustering method. Defaults to 'cluster'.
         verbose (bool): Whether to print additional info like runtimes of different steps. Defaults to False.
         nopurge (bool): Whether to keep singluar clusters before parsing. Defaults to False.
+        cpus (int): The CPU budget for DIAMOND. Omitting detects it from affinity and cgroup limits.
+        memory (int): The memory budget for DIAMOND in bytes. Omitting uses 80% of the detected (cgroup) limit.
+        block_size (float): The DIAMOND block size in billions of letters. Omitting lets DIAMOND derive it from <memory>.
+        diamond_args (List[str]): Additional arguments passed through to DIAMOND unchanged. Defaults to none.
+        store (str): A cluster store directory to reuse and update (see <cluster_incremental>). Omitting clusters everything from scratch.
+        cache_dir (str): A directory to cache grown clusters in (see ClusterCache), so reruns on the same input skip diamond. Not used with <store>. Omitting disables the cache.
+        cache_size (int): The maximal size of the cache in bytes. Defaults to 10 GiB.
+        load_workers (int): The number of parallel fasta readers (see <load_fastas>). Omitting uses the default of the pool.
+        load_processes (bool): Whether to read the fasta files in processes instead of threads. Defaults to False.
+        proteome (str): A path to keep the concatenated proteome at, with a '.fai' index. Later runs on the same files memory-map it instead of parsing (see faidx.IndexedFasta). Omitting keeps everything in memory.
     Returns:
         List[Fasta]: A list of Fasta objects, each one being one cluster.
     """
@@ -60,21 +129,56 @@ def main( # {{{
         data_file,
         sep = ",",
     )
-    # Create big List of fasta including bin names
-    fastas = [(fasta := fs.Fasta()).read(file) or fasta for file, _ in data]
+    # Create big fasta including bin names
+    start_time = time.time()
+    files = [file for file, _ in data]
     names = [name for _, name in data]
-    fasta = concat_fastas(fastas, names=names)
+    if proteome is not None and faidx.is_current(proteome, data):
+        fasta = faidx.IndexedFasta(proteome)
+        if verbose: print(f"Opening the indexed proteome took: {(time.time()-start_time):.4f}s")
+    else:
+        fasta = load_fastas(files, names=names, workers=load_workers, processes=load_processes)
+        if proteome is not None:
+            fasta = faidx.write(fasta, proteome)
+            faidx.write_sources(proteome, data)
+        if verbose: print(f"Loading {len(files)} fasta files took: {(time.time()-start_time):.4f}s")
 
-    # Run diamond on it
-    start_time = time.time()
-    clusters = diamond(fasta, threshold, executable=executable)
-    if verbose: print(f"Diamond took: {(time.time()-start_time):.4f}s")
+    options = diamond_options(cpus=cpus, memory=memory, block_size=block_size, extra_args=diamond_args)
+    if verbose: print(f"Diamond options: {shlex.join(options)}")
+    if store is not None:
+        clusters = cluster_incremental(
+            fasta,
+            store,
+            threshold,
+            executable = executable,
+            method = method,
+            options = options,
+            threads = cpus,
+            verbose = verbose
+        )
+    else:
+        clusters = None
+        if cache_dir is not None:
+            start_time = time.time()
+            cache = ch.ClusterCache(cache_dir, max_size=cache_size)
+            key = cache.key(fasta, threshold, method, executable, extra_args=diamond_args)
+            clusters = cache.get(key)
+            if verbose: print(f"Cache {'hit' if clusters is not None else 'miss'} took: {(time.time()-start_time):.4f}s")
 
-    # Turn links into an actual list
-    start_time = time.time()
-    clusters = grow_clusters(clusters)
-    end_time = time.time()
-    if verbose: print(f"Growing took: {(end_time-start_time):.4f}s")
+        if clusters is None:
+            # Run diamond on it
+            start_time = time.time()
+            links = diamond(fasta, threshold, executable=executable, method=method, options=options)
+            if verbose: print(f"Diamond took: {(time.time()-start_time):.4f}s")
+
+            # Stream the links into an actual list
+            start_time = time.time()
+            clusters = grow_clusters(links, size=len(fasta))
+            end_time = time.time()
+            if verbose: print(f"Growing took: {(end_time-start_time):.4f}s")
+
+            if cache_dir is not None:
+                cache.put(key, clusters)
 
     # purge clusters with less than two members
     if not nopurge:
@@ -92,57 +196,140 @@ def main( # {{{
     return clusters
 # }}}
 
+def cluster_incremental( #{{{
+    fasta: fs.Fasta,
+    store: str,
+    threshold: int,
+    executable: str = "./diamond/diamond",
+    method: str = "cluster",
+    options: Optional[List[str]] = None,
+    threads: Optional[int] = None,
+    verbose: bool = False
+) -> List[Set[int]]:
+    """
+    Cluster <fasta> reusing a cluster store (see ClusterStore) saved by a previous run.
+    Only sequences missing from the store are processed: they are first searched against the stored representatives and join a cluster on a hit, the rest is clustered with diamond and forms new clusters.
+    The store is created if <store> does not contain one and saved again afterwards.
+    Args:
+        fasta (Fasta): The input Fasta object.
+        store (str): The directory of the cluster store.
+        threshold (int): The identity treshold in percent. Must match the store.
+        executable (str): Path of the diamond executable. Defaults to './diamond/diamond'.
+        method (str): Either 'cluster' or 'linclust'. Must match the store. Defaults to 'cluster'.
+        options (List[str]): Resource and tuning arguments for diamond. Omitting uses <diamond_options> with detected resources.
+        threads (int): The number of threads for building the diamond database. Omitting lets diamond decide.
+        verbose (bool): Whether to print timing information. Defaults to False.
+    Returns:
+        List[Set[int]]: The clusters as integer IDs (positions in <fasta>), like <grow_clusters> with <size>.
+    Raises:
+        ValueError: If the store was built with a different threshold or method.
+    """
+    if fasta.ids is None:
+        fasta.build_index()
+    options = diamond_options() if options is None else options
+    if cs.ClusterStore.exists(store):
+        cluster_store = cs.ClusterStore.load(store)
+        if (cluster_store.threshold, cluster_store.method) != (threshold, method):
+            raise ValueError(f"The cluster store at {store} was built with threshold {cluster_store.threshold} and method {cluster_store.method}")
+        new = cluster_store.new_members(fasta)
+        changed = bool(new)
+        if new:
+            start_time = time.time()
+            new = cluster_store.assign(fasta, new, executable=executable, options=options)
+            if verbose: print(f"Assigning to {len(cluster_store)} stored clusters took: {(time.time()-start_time):.4f}s")
+    else:
+        cluster_store = cs.ClusterStore(store, threshold=threshold, method=method)
+        new = list(range(len(fasta)))
+        changed = True
+
+    if new:
+        start_time = time.time()
+        subset = fasta if len(new) == len(fasta) else fasta.subset(new)
+        centroids = set()
+        links = diamond(subset, threshold, executable=executable, method=method, options=options)
+        clusters = grow_clusters(_track_centroids(links, centroids), size=len(subset))
+        cluster_store.add_clusters(subset, clusters, centroids)
+        if verbose: print(f"Clustering {len(new)} new sequences took: {(time.time()-start_time):.4f}s")
+
+    if changed:
+        start_time = time.time()
+        cluster_store.save(executable=executable, threads=threads)
+        if verbose: print(f"Saving the cluster store took: {(time.time()-start_time):.4f}s")
+    return cluster_store.clusters(fasta)
+#}}}
+
+def _track_centroids( #{{{
+    links: Iterable[Tuple[int, int]],
+    centroids: Set[int]
+) -> Iterator[Tuple[int, int]]:
+    for centroid, member in links:
+        centroids.add(centroid)
+        yield centroid, member
+#}}}
+
 def grow_clusters( #{{{
-    clusters: List[Set[str]]
-) -> List[Set[str]]:
+    clusters: Iterable[Iterable[Hashable]],
+    size: Optional[int] = None
+) -> List[Set[Hashable]]:
     """
-    Merges all clusters with overlapping elements until only disjoint Sets (Clusters) are left
+    Merges all clusters with overlapping elements until only disjoint Sets (Clusters) are left.
+    Runs a single union-find pass over the links, so the cost is near-linear in the number of links.
     Args:
-         clusters (List[Set[str]]): A list containing sets with identifier strings.
+         clusters (Iterable[Iterable[Hashable]]): Sets (or pairs) of identifiers, e.g. the links returned by <diamond>.
+         size (int): If given, <clusters> are pairs of integer IDs from 0 to <size>-1 (see <read_pairs>) and every ID is returned, linked or not. Defaults to None.
     Returns:
-        List[Set[str]]: The resulting list of sets. All sets will be disjoint.
+        List[Set[Hashable]]: The resulting list of sets. All sets will be disjoint, ordered by the first link (or the smallest integer ID) they contain.
     """
-    while True:
-        new_clusters = []
-        merged = False
-        while clusters:
-            seed = clusters.pop(0)
-            for cluster in clusters:
-                if not seed.isdisjoint(cluster):
-                    seed = seed.union(cluster)
-                    clusters.remove(cluster)
-                    merged = True
-            new_clusters.append(seed)
-        clusters = new_clusters
-        if not merged:
-            break
-    return clusters
+    if size is not None:
+        disjoint_set = DisjointSet(size)
+        disjoint_set.union_all(clusters)
+        return [set(component) for component in disjoint_set.components()]
+    ids = {}
+    disjoint_set = DisjointSet()
+    for cluster in clusters:
+        seed = None
+        for element in cluster:
+            index = ids.get(element)
+            if index is None:
+                index = ids[element] = disjoint_set.add()
+            if seed is None:
+                seed = index
+            else:
+                disjoint_set.union(seed, index)
+    labels = list(ids)
+    return [set(labels[index] for index in component) for component in disjoint_set.components()]
 #}}}
 
 def parse_clusters( #{{{
-    clusters: List[Set[str]],
+    clusters: List[Set[Union[str, int]]],
     reference: fs.Fasta
 ) -> List[fs.Fasta]:
     """
     Turn a list of clusters into a list of their respective fasta objects.
+    Identifiers are looked up exactly, through the index of <reference> (built here if missing).
+    Each cluster is a view on <reference> (see Fasta.subset), so no sequence data is copied.
     Args:
-        clusters (List[Set[str]]): A list of sets with sequence identifiers.
+        clusters (List[Set[str | int]]): A list of sets with sequence identifiers or integer IDs (positions in <reference>).
         reference (Fasta): A single Fasta object containing all sequences (with identifiers).
     Returns:
         List[Fasta]: A list of proper Fasta objects, each being one cluster.
     Raises:
-        ValueError: If an identifier is ambiguous when looking it up in <reference>.
+        ValueError: If an identifier is missing from or ambiguous in <reference>.
     """
+    if reference.ids is None:
+        reference.build_index()
     result = []
     for cluster in clusters:
-        new_cluster = fs.Fasta()
+        positions = []
         for sequence in cluster:
-            search_result = reference.search(sequence)
-            if len(search_result) != 1:
-                raise ValueError(f"The search in the reference Fasta was faulty (found: {len(search_result)})")
-            else:
-                new_cluster.add(search_result[0])
-        result.append(new_cluster)
+            if isinstance(sequence, int):
+                positions.append(sequence)
+                continue
+            position = reference.ids.get(sequence)
+            if position is None:
+                raise ValueError(f"<{sequence}> was not found in the reference Fasta")
+            positions.append(position)
+        result.append(reference.subset(positions))
     return result
 #}}}
 
@@ -151,55 +338,123 @@ def diamond( #{{{
     threshold: int,
     executable: str = "./diamond/diamond",
     method:str = "cluster",
-    verbose:bool = False
-) -> List[set]:
+    verbose:bool = False,
+    options: Optional[List[str]] = None
+) -> Iterator[Tuple[int, int]]:
     """
-    Run diamond on a fasta returning clusters
+    Run diamond on a fasta returning its links as a stream of integer ID pairs.
+    The IDs are positions in <fasta>, interned through its index (see Fasta.build_index).
+    Runs inside its own job directory of the current work directory (see workdir.job), which is removed once the returned iterator is consumed.
     Args:
-        fasta (Fasta): The input Fasta object
+        fasta (Fasta | IndexedFasta): The input Fasta object. An IndexedFasta is passed to diamond as is, without writing a copy.
         threshold (int): The identity treshold in percent.
         executable (str): Path of the diamond executable. Defaults to './diamond/diamond'.
         method (str): Either 'cluster' or 'linclust' depending on the preferred clustering method. Defaults to 'cluster'.
         verbose (bool): Whether to allow the output of diamond on stdout. Defaults to False.
+        options (List[str]): Resource and tuning arguments for diamond. Omitting uses <diamond_options> with detected resources.
     Returns:
-        List[set]: A list of sets of cardinality 2, each containing two sequence identifiers.
+        Iterator[Tuple[int, int]]: The links, each one a pair of integer IDs (centroid, member).
+    Raises:
+        ToolError: If diamond fails (see tools.run).
     """
-    fasta.write("diamond_in")
-    command = [
-        executable,
-        method,
-        "-d",
-        "diamond_in.fasta",
-        "-o",
-        "diamond_out.tsv",
-        "--approx-id",
-        str(threshold),
-        "-M",
-        "64G"
-    ]
-    subprocess.run(
-        command,
-        stdout=None if verbose else subprocess.DEVNULL,
-        stderr=None if verbose else subprocess.DEVNULL
-    )
-    
-    diamond_out = io.read_file("diamond_out.tsv", lines=True)
+    ids = fasta.ids if fasta.ids is not None else fasta.build_index()
+    job = wd.job("diamond")
+    try:
+        if isinstance(fasta, faidx.IndexedFasta):
+            input_file = fasta.path
+        else:
+            input_file = job.file("diamond_in.fasta")
+            fasta.write(job.file("diamond_in"))
+        command = [
+            executable,
+            method,
+            "-d",
+            input_file,
+            "-o",
+            job.file("diamond_out.tsv"),
+            "--approx-id",
+            str(threshold),
+            "--tmpdir",
+            job.path,
+            *(diamond_options() if options is None else options)
+        ]
+        tl.run(command, cwd=job.path, echo=verbose, name=f"diamond {method}")
+    except BaseException:
+        job.close()
+        raise
+    return _consume_pairs(job, ids)
+#}}}
 
-    # build the clusters
-    clusters = []
-    for line in diamond_out:
-        protein1, _, protein2 = line.partition("\t")
-        clusters.append(set([protein1, protein2]))
-    # clusters = grow_clusters(clusters)
+def diamond_options( #{{{
+    cpus: Optional[int] = None,
+    memory: Optional[int] = None,
+    block_size: Optional[float] = None,
+    extra_args: List[str] = []
+) -> List[str]:
+    """
+    Build the resource and tuning arguments for diamond.
+    Args:
+        cpus (int): The number of threads. Omitting detects the usable CPUs (see resources.detect_cpus).
+        memory (int): The memory limit in bytes. Omitting uses 80% of the usable memory (see resources.detect_memory), leaving room for this process.
+        block_size (float): The block size in billions of letters. Omitting lets diamond derive it from the memory limit.
+        extra_args (List[str]): Additional arguments appended unchanged. Defaults to none.
+    Returns:
+        List[str]: The arguments.
+    """
+    cpus = rs.detect_cpus() if cpus is None else cpus
+    memory = int(rs.detect_memory() * 0.8) if memory is None else memory
+    options = ["--threads", str(cpus), "-M", rs.format_memory(memory)]
+    if block_size is not None:
+        options += ["--block-size", f"{block_size:g}"]
+    return options + list(extra_args)
+#}}}
 
-    # clean temporary files
-    try:
-        os.remove("diamond_out.tsv")
-        os.remove("diamond_in.fasta")
-    except Exception as e:
-        print(f"There was an error removing temporary files: {e}")
+def _consume_pairs( #{{{
+    job: wd.Job,
+    ids: Dict[str, int]
+) -> Iterator[Tuple[int, int]]:
+    with job:
+        yield from read_pairs(job.file("diamond_out.tsv"), ids)
+#}}}
 
-    return clusters
+def read_pairs( #{{{
+    filepath: str,
+    ids: Dict[str, int],
+    chunk_size: int = 1 << 20
+) -> Iterator[Tuple[int, int]]:
+    """
+    Stream the first two columns of a DIAMOND tsv as integer ID pairs.
+    The file is read in binary chunks, so only one chunk of lines is held in memory at a time.
+    Args:
+        filepath (str): The path to the DIAMOND output (e.g. 'centroid<TAB>member' lines).
+        ids (Dict[str, int]): The intern table mapping sequence identifiers to integer IDs, usually Fasta.ids of the input.
+        chunk_size (int): The number of bytes to read at once. Defaults to 1 MiB.
+    Returns:
+        Iterator[Tuple[int, int]]: One pair of integer IDs per line.
+    Raises:
+        ValueError: If an identifier is not part of <ids>.
+    """
+    last_token, last_id = None, None
+    rest = b""
+    with io.open_file(filepath, "rb") as file:
+        while True:
+            chunk = file.read(chunk_size)
+            lines = (rest + chunk).split(b"\n")
+            rest = lines.pop() if chunk else b""
+            for line in lines:
+                token1, _, token2 = line.rstrip(b"\r").partition(b"\t")
+                if not token2:
+                    continue
+                token2 = token2.partition(b"\t")[0]
+                try:
+                    # cluster output is grouped by centroid, so the first column mostly repeats
+                    if token1 != last_token:
+                        last_token, last_id = token1, ids[token1.decode()]
+                    yield last_id, ids[token2.decode()]
+                except KeyError as e:
+                    raise ValueError(f"Unknown sequence identifier in {filepath}: {e}") from None
+            if not chunk:
+                break
 #}}}
 
 def purge_clusters( #{{{
@@ -252,19 +507,40 @@ if __name__ == "__main__": # {{{
         action = "store_true",
         help = "Set to show the output of diamond and additional timing information."
     )
+    parser.add_argument(
+        "--cpus",
+        metavar = "N",
+        help = "The number of threads for diamond. Detected from cgroup limits if omitted.",
+        type = int
+    )
+    parser.add_argument(
+        "--memory",
+        metavar = "SIZE",
+        help = "The memory budget for diamond (e.g. '64G'). 80%% of the detected cgroup limit if omitted.",
+        type = str
+    )
+    parser.add_argument(
+        "--diamond-args",
+        metavar = "ARGS",
+        help = "Additional arguments passed through to diamond unchanged (e.g. --diamond-args='--fast').",
+        type = str
+    )
 
     args = parser.parse_args()
     # }}}
 
     # Defaults
     THRESHOLD = 30 if not args.threshold else args.threshold
-    DIAMOND = "./diamond/diamond" if not args.diamond else args.diamond-executable
+    DIAMOND = "./diamond/diamond" if not args.diamond else args.diamond
 
     clusters = main(
         data_file = args.DATA,
-        diamond_path = DIAMOND,
+        executable = DIAMOND,
         threshold = THRESHOLD,
-        verbose = args.verbose
+        verbose = args.verbose,
+        cpus = args.cpus,
+        memory = rs.parse_memory(args.memory) if args.memory else None,
+        diamond_args = shlex.split(args.diamond_args) if args.diamond_args else []
     )
     [print(cluster, "\n") for cluster in clusters]
 # }}}
@@ -0,0 +1,127 @@
+# vim: set foldmethod=marker:
+# vim: set foldclose=all foldlevel=0:
+# vim: set foldenable:
+
+from typing import List, Iterable, Tuple
+
+class DisjointSet: #{{{
+    parent: List[int]
+    rank: List[int]
+
+    def __init__( #{{{
+        self,
+        size: int = 0
+    ) -> None:
+        """
+        Create a DisjointSet (union-find) object over the integers 0 to <size>-1.
+        Uses path compression and union by rank, so a sequence of m operations runs in O(m α(n)).
+        Args:
+            size (int): The number of elements to start with, each in its own set. Defaults to 0.
+        Returns:
+            None
+        """
+        self.parent = list(range(size))
+        self.rank = [0] * size
+    #}}}
+
+    def __len__( #{{{
+        self
+    ) -> int:
+        return len(self.parent)
+    #}}}
+
+    def add( #{{{
+        self
+    ) -> int:
+        """
+        Add a new element in its own set.
+        Args:
+            None
+        Returns:
+            int: The new element.
+        """
+        self.parent.append(len(self.parent))
+        self.rank.append(0)
+        return len(self.parent) - 1
+    #}}}
+
+    def find( #{{{
+        self,
+        element: int
+    ) -> int:
+        """
+        Find the representative of the set containing <element>, compressing the path on the way.
+        Args:
+            element (int): The element to look up.
+        Returns:
+            int: The representative (root) of its set.
+        """
+        parent = self.parent
+        root = element
+        while parent[root] != root:
+            root = parent[root]
+        while parent[element] != root:
+            parent[element], element = root, parent[element]
+        return root
+    #}}}
+
+    def union( #{{{
+        self,
+        a: int,
+        b: int
+    ) -> int:
+        """
+        Merge the sets containing <a> and <b>.
+        Args:
+            a (int): An element of the first set.
+            b (int): An element of the second set.
+        Returns:
+            int: The representative of the merged set.
+        """
+        root_a = self.find(a)
+        root_b = self.find(b)
+        if root_a == root_b:
+            return root_a
+        rank = self.rank
+        if rank[root_a] < rank[root_b]:
+            root_a, root_b = root_b, root_a
+        self.parent[root_b] = root_a
+        if rank[root_a] == rank[root_b]:
+            rank[root_a] += 1
+        return root_a
+    #}}}
+
+    def union_all( #{{{
+        self,
+        pairs: Iterable[Tuple[int, int]]
+    ) -> None:
+        """
+        Merge the sets of every pair in one pass.
+        Args:
+            pairs (Iterable[Tuple[int, int]]): The links to apply.
+        Returns:
+            None
+        """
+        union = self.union
+        for a, b in pairs:
+            union(a, b)
+    #}}}
+
+    def components( #{{{
+        self
+    ) -> List[List[int]]:
+        """
+        Return all sets (connected components).
+        Components are ordered by their smallest element, members ascending.
+        Args:
+            None
+        Returns:
+            List[List[int]]: One list of elements per component.
+        """
+        find = self.find
+        groups = {}
+        for element in range(len(self.parent)):
+            groups.setdefault(find(element), []).append(element)
+        return list(groups.values())
+    #}}}
+#}}}
@@ -0,0 +1,335 @@
+# vim: set foldmethod=marker:
+# vim: set foldclose=all foldlevel=0:
+# vim: set foldenable:
+
+from __future__ import annotations
+from typing import List, Dict, Iterable, Iterator
+from array import array
+import mmap
+import os
+
+import fasta as fs
+import io_helpers as io
+
+def index_path( #{{{
+    path: str
+) -> str:
+    return f"{path}.fai"
+#}}}
+
+def build_index( #{{{
+    path: str
+) -> None:
+    """
+    Create a samtools style '.fai' index (name, length, offset, line bases, line width) next to a fasta file.
+    Args:
+        path (str): The path of the fasta file.
+    Returns:
+        None
+    Raises:
+        ValueError: If the lines of a record are not wrapped uniformly.
+    """
+    rows = []
+    with open(path, "rb") as file:
+        name, length, offset, line_bases, line_width, short = None, 0, 0, 0, 0, False
+        position = 0
+        for line in file:
+            if line.startswith(b">"):
+                if name is not None:
+                    rows.append(f"{name}\t{length}\t{offset}\t{line_bases}\t{line_width}\n")
+                name = fs.header_id(line.decode().strip())
+                length, offset, line_bases, line_width, short = 0, position + len(line), 0, 0, False
+            elif name is not None and line.strip():
+                bases = len(line.rstrip(b"\r\n"))
+                if short or (line_bases and bases > line_bases):
+                    raise ValueError(f"Record <{name}> in {path} is not wrapped uniformly")
+                if not line_bases:
+                    line_bases, line_width = bases, len(line)
+                elif bases < line_bases:
+                    short = True
+                length += bases
+            position += len(line)
+        if name is not None:
+            rows.append(f"{name}\t{length}\t{offset}\t{line_bases}\t{line_width}\n")
+    io.write_file(index_path(path), rows)
+#}}}
+
+def write( #{{{
+    fasta: fs.Fasta,
+    path: str
+) -> IndexedFasta:
+    """
+    Write a Fasta object unwrapped to <path>, creating the '.fai' index in the same pass.
+    Args:
+        fasta (Fasta): The sequences to write.
+        path (str): The path of the new fasta file.
+    Returns:
+        IndexedFasta: The written file, opened for random access.
+    """
+    rows = []
+    position = 0
+    with open(path, "wb") as file:
+        for sequence in fasta:
+            header = sequence.header.encode()
+            residues = sequence.residues
+            file.write(b"%s\n%s\n" % (header, residues))
+            position += len(header) + 1
+            rows.append(f"{fs.header_id(sequence.header)}\t{len(residues)}\t{position}\t{len(residues)}\t{len(residues) + 1}\n")
+            position += len(residues) + 1
+    io.write_file(index_path(path), rows)
+    return IndexedFasta(path)
+#}}}
+
+class IndexedFasta: #{{{
+    path: str
+    names: List[str]
+    sequence_lengths: array
+    offsets: array
+    line_bases: array
+    line_widths: array
+    ids: Dict[str, int]
+    distmat: None
+
+    def __init__( #{{{
+        self,
+        path: str
+    ) -> None:
+        """
+        Open a fasta file for random access through its '.fai' index, without reading it into memory.
+        The file is memory-mapped and sequences are only read when asked for, so the object can stand in for a (read-only) Fasta object, e.g. as reference in clustering.parse_clusters.
+        The index is (re)built if it is missing or older than the file.
+        Args:
+            path (str): The path of the fasta file, made absolute as tools run in their own job directories.
+        Returns:
+            None
+        """
+        self.path = os.path.abspath(path)
+        self.distmat = None
+        fai = index_path(path)
+        if not os.path.isfile(fai) or os.path.getmtime(fai) < os.path.getmtime(path):
+            build_index(path)
+        self.names = []
+        self.sequence_lengths = array("q")
+        self.offsets = array("q")
+        self.line_bases = array("q")
+        self.line_widths = array("q")
+        for name, length, offset, line_bases, line_width in io.parse_csv(fai, sep="\t"):
+            self.names.append(name)
+            self.sequence_lengths.append(int(length))
+            self.offsets.append(int(offset))
+            self.line_bases.append(int(line_bases))
+            self.line_widths.append(int(line_width))
+        self.ids = {name: position for position, name in enumerate(self.names)}
+        self._file = open(path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(path) else b""
+    #}}}
+
+    def __enter__( #{{{
+        self
+    ) -> IndexedFasta:
+        return self
+    #}}}
+
+    def __exit__( #{{{
+        self,
+        *_
+    ) -> None:
+        self.close()
+    #}}}
+
+    def close( #{{{
+        self
+    ) -> None:
+        """
+        Release the memory map and the file.
+        Args:
+            None
+        Returns:
+            None
+        """
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+        self._file.close()
+    #}}}
+
+    def __len__( #{{{
+        self
+    ) -> int:
+        return len(self.names)
+    #}}}
+
+    def __getitem__( #{{{
+        self,
+        key
+    ):
+        if isinstance(key, slice):
+            return self.subset(range(len(self))[key])
+        return fs.Sequence(header=self.header(key), sequence=self.residues(key))
+    #}}}
+
+    def __iter__( #{{{
+        self
+    ) -> Iterator[fs.Sequence]:
+        return (self[position] for position in range(len(self)))
+    #}}}
+
+    def __str__( #{{{
+        self
+    ):
+        return "\n".join(repr(sequence) for sequence in self)
+    #}}}
+
+    def build_index( #{{{
+        self
+    ) -> Dict[str, int]:
+        """
+        Return the exact-ID index (see Fasta.build_index), which is always available from the '.fai' file.
+        Args:
+            None
+        Returns:
+            Dict[str, int]: The index, also stored as the <ids> attribute.
+        """
+        return self.ids
+    #}}}
+
+    def header( #{{{
+        self,
+        index: int
+    ) -> str:
+        """
+        Read the full header line of a sequence (the line right before its offset).
+        Args:
+            index (int): The position of the sequence.
+        Returns:
+            str: The header including '>'.
+        """
+        end = self.offsets[index] - 1
+        start = self._map.rfind(b"\n", 0, end) + 1
+        return self._map[start:end].decode().strip()
+    #}}}
+
+    def headers( #{{{
+        self
+    ) -> List[str]:
+        return [self.header(position) for position in range(len(self))]
+    #}}}
+
+    def lengths( #{{{
+        self
+    ) -> List[int]:
+        return self.sequence_lengths.tolist()
+    #}}}
+
+    def residues( #{{{
+        self,
+        index: int
+    ) -> bytes:
+        """
+        Read the residues of a sequence from the memory map.
+        Args:
+            index (int): The position of the sequence.
+        Returns:
+            bytes: The sequence without line breaks.
+        """
+        length, offset = self.sequence_lengths[index], self.offsets[index]
+        line_bases, line_width = self.line_bases[index], self.line_widths[index]
+        if length == 0:
+            return b""
+        full_lines, remainder = divmod(length, line_bases)
+        data = self._map[offset:offset + full_lines * line_width + remainder]
+        if full_lines == 0 or (full_lines == 1 and remainder == 0):
+            # a single line, e.g. unwrapped records
+            return data[:length]
+        return data.replace(b"\r", b"").replace(b"\n", b"")
+    #}}}
+
+    def get( #{{{
+        self,
+        index: int
+    ) -> fs.Sequence:
+        return self[index]
+    #}}}
+
+    def search( #{{{
+        self,
+        search: str,
+        exact: bool = True
+    ) -> List[fs.Sequence]:
+        """
+        Look up a sequence by its identifier.
+        Args:
+            search (str): The sequence identifier.
+            exact (bool): Only exact lookups are supported. Defaults to True.
+        Returns:
+            List[Sequence]: The matching sequence, or an empty list.
+        Raises:
+            ValueError: If <exact> is False.
+        """
+        if not exact:
+            raise ValueError("IndexedFasta only supports exact lookups")
+        position = self.ids.get(search)
+        return [] if position is None else [self[position]]
+    #}}}
+
+    def subset( #{{{
+        self,
+        positions: Iterable[int]
+    ) -> fs.Fasta:
+        """
+        Read some sequences into a new (in-memory) Fasta object.
+        Args:
+            positions (Iterable[int]): The positions of the sequences to read, in the order given.
+        Returns:
+            Fasta: The sequences.
+        """
+        result = fs.Fasta()
+        for position in positions:
+            result.rows.append(result.store.append(self.header(position), self.residues(position)))
+        return result
+    #}}}
+#}}}
+
+def is_current( #{{{
+    path: str,
+    sources: List[List[str]]
+) -> bool:
+    """
+    Check whether a proteome written by <write_sources> is still valid for the given source files.
+    Args:
+        path (str): The path of the proteome fasta file.
+        sources (List[List[str]]): The rows of the data csv ([file, name]).
+    Returns:
+        bool: True if the proteome and its index exist and were built from exactly these unchanged files.
+    """
+    if not all(os.path.isfile(file) for file in (path, index_path(path), f"{path}.sources")):
+        return False
+    try:
+        return io.read_file(f"{path}.sources") == _describe(sources)
+    except OSError:
+        return False
+#}}}
+
+def write_sources( #{{{
+    path: str,
+    sources: List[List[str]]
+) -> None:
+    """
+    Record which source files a proteome was built from (see <is_current>).
+    Args:
+        path (str): The path of the proteome fasta file.
+        sources (List[List[str]]): The rows of the data csv ([file, name]).
+    Returns:
+        None
+    """
+    io.write_file(f"{path}.sources", _describe(sources))
+#}}}
+
+def _describe( #{{{
+    sources: List[List[str]]
+) -> str:
+    lines = []
+    for file, name in sources:
+        stat = os.stat(file)
+        lines.append(f"{file}\t{name}\t{stat.st_size}\t{stat.st_mtime_ns}")
+    return "\n".join(lines)
+#}}}
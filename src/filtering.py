@@ -31,7 +31,7 @@ def filter_gaps( #{{{
     average:bool = True
 ) -> List[fs.Fasta]:
     """
-    Filter a list of clusters (Fasta objects) by their gaps.
+    Filter a list of aligned clusters (Fasta objects) by their gaps.
     Args:
         clusters (List[Fasta]): The list to filter.
         threshold (int): The maximal number of gaps to keep.
@@ -40,7 +40,18 @@ def filter_gaps( #{{{
     Returns:
         List[Fasta]: A list of all Fasta objects that passed the filter.
     """
-    return [fasta for fasta in clusters if fasta.count(symbol="-", absolute=absolute, average=average)<=threshold]
+    result = []
+    for fasta in clusters:
+        alignment = fasta.alignment()
+        if absolute and not average:
+            gaps = alignment.gap_count()
+        elif absolute and average:
+            gaps = alignment.gap_count()/len(alignment)
+        else:
+            gaps = alignment.gap_fraction()
+        if gaps<=threshold:
+            result.append(fasta)
+    return result
 #}}}
 
 ## UniRefID
@@ -71,11 +82,11 @@ def filter_uniref( #{{{
     for cluster in clusters:
         ids = set()
         missing_id = False
-        for seq in cluster:
+        for header in cluster.headers():
             if sep:
-                _, _, tag = seq.header.partition(sep)
+                _, _, tag = header.partition(sep)
             else:
-                tag = seq.header
+                tag = header
             id = lookup.get_uniref(tag.split(' ', 1)[0], level)
             if id:
                 ids.add(id)
@@ -108,7 +119,8 @@ def filter_length( #{{{
     """
     result = []
     for fasta in clusters:
-        ratio = len(min(fasta.sequences)) / len(max(fasta.sequences))
+        lengths = fasta.lengths()
+        ratio = min(lengths) / max(lengths)
         if ratio >= 1-threshold:
             result.append(fasta)
     return result
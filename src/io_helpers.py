@@ -2,15 +2,162 @@
 # vim: set foldclose=all foldlevel=0:
 # vim: set foldenable: 
 
-from typing import List, Tuple, Optional, Union
+from typing import List, Tuple, Optional, Union, IO
 import re
+import io
+import gzip
+import shutil
+import subprocess
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+EXTENSIONS = {".gz": "gzip", ".bgz": "bgzip", ".zst": "zstd", ".zstd": "zstd"}
+
+class _ProcessStream(io.BufferedIOBase): #{{{
+    """
+    A binary stream backed by the stdin or stdout pipe of a (de)compression process.
+    Closing it waits for the process and raises OSError if it failed.
+    """
+    def __init__(self, process: subprocess.Popen, stream: IO[bytes], output: Optional[IO[bytes]] = None):
+        super().__init__()
+        self._process = process
+        self._stream = stream
+        self._output = output
+
+    def readable(self) -> bool:
+        return self._stream.readable()
+
+    def writable(self) -> bool:
+        return self._stream.writable()
+
+    def read(self, size: int = -1) -> bytes:
+        return self._stream.read(size)
+
+    def read1(self, size: int = -1) -> bytes:
+        return self._stream.read1(size)
+
+    def write(self, data) -> int:
+        return self._stream.write(data)
+
+    def flush(self) -> None:
+        if not self._stream.closed and self._stream.writable():
+            self._stream.flush()
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self._stream.close()
+        returncode = self._process.wait()
+        if self._output is not None:
+            self._output.close()
+        super().close()
+        # a reader closed early makes the process fail with SIGPIPE, which is expected
+        if returncode not in (0, -13):
+            raise OSError(f"{self._process.args[0]} exited with code {returncode}")
+#}}}
+
+def detect_compression( #{{{
+    filepath: str
+) -> Optional[str]:
+    """
+    Detect the compression of a file from its magic bytes.
+    Args:
+        filepath (str): The path to the file.
+    Returns:
+        str or None: 'gzip' (including bgzip), 'zstd' or None for uncompressed files.
+    """
+    with open(filepath, 'rb') as file:
+        magic = file.read(4)
+    if magic.startswith(GZIP_MAGIC):
+        return "gzip"
+    if magic.startswith(ZSTD_MAGIC):
+        return "zstd"
+    return None
+#}}}
+
+def open_file( #{{{
+    filepath: str,
+    mode: str = 'r',
+    threads: Optional[int] = None,
+    buffering: int = -1
+) -> IO:
+    """
+    Open a file, transparently (de)compressing gzip, bgzip and zstd.
+    Reading detects the format from the magic bytes, writing from the extension ('.gz', '.bgz', '.zst').
+    Multi-threaded tools (pigz, bgzip, zstd) are used when available, otherwise the python modules.
+    Args:
+        filepath (str): The path to the file.
+        mode (str): One of 'r', 'rb', 'w' and 'wb'. Defaults to 'r'.
+        threads (int): The number of threads for (de)compression. Omitting uses all usable CPUs.
+        buffering (int): The buffer size for uncompressed files, like for open. Defaults to the system default.
+    Returns:
+        IO: A text or binary (see <mode>) file object. Use it as context manager.
+    Raises:
+        ImportError: If a zstd file is opened and neither the zstd tool nor the zstandard module is available.
+    """
+    binary = 'b' in mode
+    reading = 'r' in mode
+    if reading:
+        compression = detect_compression(filepath)
+    else:
+        compression = next((name for extension, name in EXTENSIONS.items() if filepath.endswith(extension)), None)
+    if compression is None:
+        return open(filepath, mode, buffering=buffering)
+    if threads is None:
+        import resources
+        threads = resources.detect_cpus()
+    handle = _open_reader(filepath, compression, threads) if reading else _open_writer(filepath, compression, threads)
+    return handle if binary else io.TextIOWrapper(handle, encoding="utf-8")
+#}}}
+
+def _open_reader( #{{{
+    filepath: str,
+    compression: str,
+    threads: int
+) -> IO[bytes]:
+    tool = {"gzip": "pigz", "zstd": "zstd"}[compression]
+    if shutil.which(tool):
+        # zstd decompression is single-threaded, pigz uses extra threads for reading, writing and checksums
+        command = [tool, "-dcq", f"-p{threads}", filepath] if tool == "pigz" else [tool, "-dcq", filepath]
+        process = subprocess.Popen(command, stdout=subprocess.PIPE)
+        return _ProcessStream(process, process.stdout)
+    if compression == "gzip":
+        return gzip.open(filepath, 'rb')
+    if zstandard is None:
+        raise ImportError(f"Reading {filepath} requires the zstd tool or the zstandard module")
+    return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(filepath, 'rb'), closefd=True))
+#}}}
+
+def _open_writer( #{{{
+    filepath: str,
+    compression: str,
+    threads: int
+) -> IO[bytes]:
+    tool = {"gzip": "pigz", "bgzip": "bgzip", "zstd": "zstd"}[compression]
+    if shutil.which(tool):
+        threads_option = {"pigz": f"-p{threads}", "bgzip": f"-@{threads}", "zstd": f"-T{threads}"}[tool]
+        output = open(filepath, 'wb')
+        process = subprocess.Popen([tool, "-c", threads_option] + (["-q"] if tool == "zstd" else []), stdin=subprocess.PIPE, stdout=output)
+        return _ProcessStream(process, process.stdin, output)
+    if compression in ("gzip", "bgzip"):
+        # without bgzip, plain gzip is written: readable by all tools, but not block-indexable
+        return gzip.open(filepath, 'wb')
+    if zstandard is None:
+        raise ImportError(f"Writing {filepath} requires the zstd tool or the zstandard module")
+    return zstandard.ZstdCompressor(threads=-1).stream_writer(open(filepath, 'wb'), closefd=True)
+#}}}
 
 def read_file( #{{{
     filepath: str,
     lines: bool = False
 ) -> Optional[Union[str, List[str]]]:
     """
-    Read contents from a file
+    Read contents from a file, decompressing gzip, bgzip and zstd transparently (see <open_file>)
 
     Args:
         filepath (str): The path to the file from which should be read
@@ -20,7 +167,7 @@ def read_file( #{{{
         str or List[str] or None: A string, a list of lines in the file or None if there was an error reading from the file
     """
     try:
-        with open(filepath, 'r') as file:
+        with open_file(filepath, 'r') as file:
             if lines:
                 content = [line.strip() for line in file.readlines()]
             else:
@@ -39,14 +186,14 @@ def write_file( #{{{
     content: Union[str, List[str]]
 ) -> None:
     """
-    Write content to a file
+    Write content to a file, compressed if the extension asks for it (see <open_file>)
     
     Args:
         filepath (str): The path of the file to be written
         content (str, List[str]): The content to be written. Either a sing€ string or a list of strings.
     """
     try:
-        with open(filepath, 'w') as file:
+        with open_file(filepath, 'w') as file:
             if isinstance(content, list):
                 file.writelines(content)
             else:
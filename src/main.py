@@ -2,13 +2,18 @@
 # vim: set foldclose=all foldlevel=0:
 # vim: set foldenable: 
 
-import argparse, os, time
-from typing import Optional
+import argparse, os, shlex, time
+from typing import Optional, List
 
 import clustering as cl
+import aligning as ag
+import tree_building as tb
 import filtering as fl
 import bakta_table as bt
 import io_helpers as io
+import workdir as wd
+import tools as tl
+import resources as rs
 
 def main(
     data_file,
@@ -28,9 +33,31 @@ def main(
     out_file = None,
     nopurge:bool = False,
     images:Optional[str] = None,
-    ascii:Optional[str] = None
+    ascii:Optional[str] = None,
+    workdir:Optional[str] = None,
+    keep_temp:bool = False,
+    cpus:Optional[int] = None,
+    memory:Optional[int] = None,
+    block_size:Optional[float] = None,
+    diamond_args:List[str] = [],
+    store:Optional[str] = None,
+    cache_dir:Optional[str] = None,
+    cache_size:int = 10 * 1024**3,
+    load_workers:Optional[int] = None,
+    load_processes:bool = False,
+    proteome:Optional[str] = None,
+    align_workers:Optional[int] = None,
+    align_threads:Optional[int] = None,
+    large_cluster:int = 1000,
+    tool_timeout:Optional[float] = None,
+    distance:str = "clustalo",
+    tree_method:str = "upgma",
+    tree_workers:Optional[int] = None
 ):
     start_time_total = time.time()   
+    run = wd.configure(base=workdir, keep=keep_temp)
+    if verbose: print(f">>> Using work directory {run.path}")
+    runner = tl.configure(limit=cpus, timeout=tool_timeout)
     # Step 1: Creating clusters with diamond
     if verbose: print(">>> Start Clustering")
     time_clustering = time.time()
@@ -40,7 +67,17 @@ def main(
         threshold = threshold,
         method = method,
         verbose = timing,
-        nopurge = nopurge
+        nopurge = nopurge,
+        cpus = cpus,
+        memory = memory,
+        block_size = block_size,
+        diamond_args = diamond_args,
+        store = store,
+        cache_dir = cache_dir,
+        cache_size = cache_size,
+        load_workers = load_workers,
+        load_processes = load_processes,
+        proteome = proteome
     )
     if verbose: print(f"Clustering found {len(clusters)} clusters")
     if timing: print(f"Clustering took: {time.time()-time_clustering:.4f}s")
@@ -67,7 +104,15 @@ def main(
     # Step 3: Clustalo
     if verbose: print(">>> Start Alignment and Distance matrix calculation")
     time_clustalo = time.time()
-    clusters = [cluster.clustalo() for cluster in clusters]
+    clusters = ag.clustalo_clusters(
+        clusters,
+        workers = align_workers,
+        threads = align_threads,
+        large_size = large_cluster,
+        cpus = cpus,
+        timing = timing,
+        distance = distance
+    )
     if timing: print(f"Aligning took: {time.time()-time_clustalo:.4f}s")
     
     # Step 4: Filter by gaps
@@ -117,28 +162,31 @@ def main(
     # Step 8: Trees
     if verbose: print(">>> Start calculating trees")
     time_trees = time.time()
-    trees = [cluster.distmat.upgma() for cluster in clusters]
+    trees = tb.build_trees([cluster.distmat for cluster in clusters], method=tree_method, workers=tree_workers or cpus)
     if timing: print(f"Calculating Trees took: {time.time()-time_trees:.4f}s")
 
     # Step 9: Output
     if out_file:
         if verbose: print(">>> Now writing to file")
-        io.write_file(out_file, "\n".join(trees))
+        io.write_file(out_file, "\n".join(tree.newick() for tree in trees))
     else:
-        [print(tree) for tree in trees]
+        [print(tree.newick()) for tree in trees]
 
     if images:
         if verbose: print(">>> Now creating tree image files")
         import draw
         for index,tree in enumerate(trees):
-            draw.draw(tree, mode='save', path=os.path.join(images, f"{index:0{len(str(len(trees)))}}.png"))
+            draw.draw(tree.newick(), mode='save', path=os.path.join(images, f"{index:0{len(str(len(trees)))}}.png"))
 
     if ascii:
         if verbose: print(">>> Now creating ascii tree files")
         import draw
         for index,tree in enumerate(trees):
-            draw.draw(tree, mode='ascii', path=os.path.join(ascii, f"{index:0{len(str(len(trees)))}}.txt"))
+            draw.draw(tree.newick(), mode='ascii', path=os.path.join(ascii, f"{index:0{len(str(len(trees)))}}.txt"))
 
+    if timing:
+        for name, (calls, total, longest) in runner.report().items():
+            print(f"{name}: {calls} calls took {total:.4f}s (longest {longest:.4f}s)")
     if timing: print(f"Total Time:: {time.time()-start_time_total:.4f}s")
 
 if __name__ == "__main__":
@@ -251,6 +299,118 @@ if __name__ == "__main__":
         help = "Do not purge singleton clusters before parsing them.",
         action = "store_true"
     )
+    parser.add_argument(
+        "--cpus",
+        metavar = "N",
+        help = "The CPU budget (threads for DIAMOND). Detected from cgroup limits if omitted.",
+        type = int
+    )
+    parser.add_argument(
+        "--memory",
+        metavar = "SIZE",
+        help = "The memory budget for DIAMOND (e.g. '64G'). 80%% of the detected cgroup limit if omitted.",
+        type = str
+    )
+    parser.add_argument(
+        "--block-size",
+        metavar = "BLOCK_SIZE",
+        help = "The DIAMOND block size in billions of letters. Derived from the memory budget if omitted.",
+        type = float
+    )
+    parser.add_argument(
+        "--diamond-args",
+        metavar = "ARGS",
+        help = "Additional arguments passed through to DIAMOND unchanged (e.g. --diamond-args='--fast').",
+        type = str
+    )
+    parser.add_argument(
+        "--store",
+        metavar = "FOLDER",
+        help = "A cluster store to reuse and update, so only new proteins are clustered. Created if it does not exist.",
+        type = str
+    )
+    parser.add_argument(
+        "--cache-dir",
+        metavar = "FOLDER",
+        help = "A directory to cache DIAMOND clusters in, so reruns on the same input skip DIAMOND. Not used if omitted.",
+        type = str
+    )
+    parser.add_argument(
+        "--cache-size",
+        metavar = "SIZE",
+        help = "The maximal size of the cache (e.g. '10G'), least recently used entries are evicted first. Defaults to 10G.",
+        type = str
+    )
+    parser.add_argument(
+        "--load-workers",
+        metavar = "N",
+        help = "The number of fasta files to read in parallel. Defaults to the thread pool default.",
+        type = int
+    )
+    parser.add_argument(
+        "--load-processes",
+        help = "Read fasta files in separate processes instead of threads.",
+        action = "store_true"
+    )
+    parser.add_argument(
+        "--proteome",
+        metavar = "FILE",
+        help = "Keep the concatenated proteome in this file with a .fai index. Later runs on the same input memory-map it instead of parsing.",
+        type = str
+    )
+    parser.add_argument(
+        "--distance",
+        help = "The source of the distance matrices: clustalo's k-tuple distances or p-distance, Poisson or Kimura distances calculated from the alignment (clustalo then skips its full distance matrix). Defaults to clustalo.",
+        choices = ["clustalo", "p", "poisson", "kimura"],
+        type = str
+    )
+    parser.add_argument(
+        "--tree-method",
+        help = "The tree building method: UPGMA (ultrametric, rooted) or neighbour joining (unrooted, no molecular clock). Defaults to upgma.",
+        choices = ["upgma", "nj"],
+        type = str
+    )
+    parser.add_argument(
+        "--tree-workers",
+        metavar = "N",
+        help = "The number of processes building trees. Defaults to the CPU budget, 1 builds them in the main process.",
+        type = int
+    )
+    parser.add_argument(
+        "--align-workers",
+        metavar = "N",
+        help = "The number of clustalo processes to run at once. Defaults to the CPU budget.",
+        type = int
+    )
+    parser.add_argument(
+        "--align-threads",
+        metavar = "N",
+        help = "The number of clustalo threads for large clusters. Defaults to the CPU budget, but at most 8.",
+        type = int
+    )
+    parser.add_argument(
+        "--large-cluster",
+        metavar = "CLUSTER_SIZE",
+        help = "The minimal size of a cluster to align with several threads, defaults to 1000",
+        type = int
+    )
+    parser.add_argument(
+        "--tool-timeout",
+        metavar = "SECONDS",
+        help = "The time limit for a single call of an external tool. No limit if omitted.",
+        type = float
+    )
+    parser.add_argument(
+        "--workdir",
+        metavar = "FOLDER",
+        help = "The base path for temporary files of external tools (e.g. a local disk or /dev/shm). Defaults to the system temp directory.",
+        type = str
+    )
+    parser.add_argument(
+        "--keep-temp",
+        help = "Keep the temporary files of external tools for debugging.",
+        action = "store_true"
+    )
 
     args = parser.parse_args()
     # }}}
@@ -278,5 +438,24 @@ if __name__ == "__main__":
     if args.ur100: params["uniref100_threshold"] = args.ur100
     if args.out: params["out_file"] = args.out
     if args.nopurge: params["nopurge"] = args.nopurge
+    if args.workdir: params["workdir"] = args.workdir
+    if args.store: params["store"] = args.store
+    if args.cache_dir: params["cache_dir"] = args.cache_dir
+    if args.cache_size: params["cache_size"] = rs.parse_memory(args.cache_size)
+    if args.load_workers: params["load_workers"] = args.load_workers
+    if args.load_processes: params["load_processes"] = args.load_processes
+    if args.proteome: params["proteome"] = args.proteome
+    if args.cpus: params["cpus"] = args.cpus
+    if args.memory: params["memory"] = rs.parse_memory(args.memory)
+    if args.block_size: params["block_size"] = args.block_size
+    if args.diamond_args: params["diamond_args"] = shlex.split(args.diamond_args)
+    if args.keep_temp: params["keep_temp"] = args.keep_temp
+    if args.align_workers: params["align_workers"] = args.align_workers
+    if args.align_threads: params["align_threads"] = args.align_threads
+    if args.large_cluster: params["large_cluster"] = args.large_cluster
+    if args.tool_timeout: params["tool_timeout"] = args.tool_timeout
+    if args.distance: params["distance"] = args.distance
+    if args.tree_method: params["tree_method"] = args.tree_method
+    if args.tree_workers: params["tree_workers"] = args.tree_workers
 
     main(**params)
@@ -0,0 +1,102 @@
+# vim: set foldmethod=marker:
+# vim: set foldclose=all foldlevel=0:
+# vim: set foldenable:
+
+from typing import Optional
+import math
+import os
+
+def _read_first( #{{{
+    *paths: str
+) -> Optional[str]:
+    for path in paths:
+        try:
+            with open(path, 'r') as file:
+                return file.read().strip()
+        except (OSError, ValueError):
+            continue
+    return None
+#}}}
+
+def detect_cpus( #{{{
+) -> int:
+    """
+    Detect the number of CPUs this process may use.
+    Honours the CPU affinity mask and cgroup v2 (cpu.max) or v1 (cfs quota) limits.
+    Args:
+        None
+    Returns:
+        int: The number of usable CPUs, at least 1.
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+
+    quota, period = None, None
+    cpu_max = _read_first("/sys/fs/cgroup/cpu.max")
+    if cpu_max:
+        limit, _, interval = cpu_max.partition(" ")
+        if limit != "max":
+            quota, period = int(limit), int(interval or 100000)
+    else:
+        limit = _read_first("/sys/fs/cgroup/cpu/cpu.cfs_quota_us", "/sys/fs/cgroup/cpu,cpuacct/cpu.cfs_quota_us")
+        interval = _read_first("/sys/fs/cgroup/cpu/cpu.cfs_period_us", "/sys/fs/cgroup/cpu,cpuacct/cpu.cfs_period_us")
+        if limit and interval and int(limit) > 0:
+            quota, period = int(limit), int(interval)
+    if quota and period:
+        cpus = min(cpus, math.ceil(quota / period))
+    return max(1, cpus)
+#}}}
+
+def detect_memory( #{{{
+) -> int:
+    """
+    Detect the amount of memory this process may use.
+    Honours cgroup v2 (memory.max) or v1 (memory.limit_in_bytes) limits, falling back to the physical memory.
+    Args:
+        None
+    Returns:
+        int: The usable memory in bytes.
+    """
+    memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    limit = _read_first("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes")
+    if limit and limit.isdigit():
+        memory = min(memory, int(limit))
+    return memory
+#}}}
+
+def parse_memory( #{{{
+    memory: str
+) -> int:
+    """
+    Parse a human readable memory size like '64G', '512M' or '1.5T' (binary units).
+    Args:
+        memory (str): The memory size. Plain numbers are bytes.
+    Returns:
+        int: The size in bytes.
+    Raises:
+        ValueError: If <memory> is not a valid size.
+    """
+    units = {"": 0, "K": 1, "M": 2, "G": 3, "T": 4}
+    value = memory.strip().upper().removesuffix("B")
+    unit = value[-1:] if value[-1:] in units and value[-1:] != "" else ""
+    try:
+        number = float(value[:len(value) - len(unit)])
+    except ValueError:
+        raise ValueError(f"Invalid memory size: {memory}") from None
+    return int(number * 1024 ** units[unit])
+#}}}
+
+def format_memory( #{{{
+    memory: int
+) -> str:
+    """
+    Format a size in bytes as whole gigabytes (at least 1G), the way DIAMOND expects it for '-M'.
+    Args:
+        memory (int): The size in bytes.
+    Returns:
+        str: The size, e.g. '64G'.
+    """
+    return f"{max(1, memory // 1024**3)}G"
+#}}}
@@ -0,0 +1,378 @@
+# vim: set foldmethod=marker:
+# vim: set foldclose=all foldlevel=0:
+# vim: set foldenable:
+
+from __future__ import annotations
+from typing import List, Dict, Optional, Union, Callable, Any, BinaryIO
+import asyncio
+import atexit
+import concurrent.futures
+import os
+import shlex
+import threading
+import time
+
+import resources as rs
+
+Feed = Callable[[BinaryIO], None]
+Consume = Callable[[BinaryIO], Any]
+
+class ToolError(RuntimeError): #{{{
+    command: List[str]
+    returncode: Optional[int]
+    stderr: str
+
+    def __init__( #{{{
+        self,
+        command: List[str],
+        returncode: Optional[int],
+        stderr: bytes = b"",
+        reason: str = ""
+    ) -> None:
+        """
+        Create a ToolError, raised when an external tool fails or times out.
+        Args:
+            command (List[str]): The command that failed.
+            returncode (int): Its exit code, None if it was killed after a timeout.
+            stderr (bytes): What the tool wrote to stderr.
+            reason (str): A description of the failure. Defaults to the exit code.
+        Returns:
+            None
+        """
+        self.command = command
+        self.returncode = returncode
+        self.stderr = stderr.decode(errors="replace").strip()
+        message = f"{shlex.join(command)} {reason or f'failed with exit code {returncode}'}"
+        super().__init__(f"{message}:\n{self.stderr[-2000:]}" if self.stderr else message)
+    #}}}
+#}}}
+
+class Channel: #{{{
+    index: int
+    prefix: str
+
+    def __init__( #{{{
+        self,
+        index: int,
+        prefix: str = ""
+    ) -> None:
+        """
+        Create a Channel object, a placeholder in a command for an extra output pipe of the tool (see Runner.submit).
+        It is replaced by <prefix> followed by the path of the pipe (e.g. '--distmat-out=/dev/fd/5').
+        Args:
+            index (int): The position of the consumer in <channels>.
+            prefix (str): The text in front of the path, e.g. the option name. Defaults to none.
+        Returns:
+            None
+        """
+        self.index = index
+        self.prefix = prefix
+    #}}}
+#}}}
+
+class Call: #{{{
+    name: str
+    command: List[str]
+    seconds: float
+    returncode: Optional[int]
+
+    def __init__( #{{{
+        self,
+        name: str,
+        command: List[str],
+        seconds: float,
+        returncode: Optional[int]
+    ) -> None:
+        """
+        Create a Call object, the timing record of one external tool call.
+        """
+        self.name = name
+        self.command = command
+        self.seconds = seconds
+        self.returncode = returncode
+    #}}}
+#}}}
+
+class Runner: #{{{
+    limit: int
+    timeout: Optional[float]
+    calls: List[Call]
+
+    def __init__( #{{{
+        self,
+        limit: Optional[int] = None,
+        timeout: Optional[float] = None
+    ) -> None:
+        """
+        Create a Runner object that runs external tools on its own asyncio event loop (in a background thread).
+        Calls can be made from any thread (see <run> and <submit>), at most <limit> tools run at once and every call is timed (see <calls>).
+        Stdin and stdout can be streamed through pipes by callables running in helper threads, so the data is neither buffered twice nor parsed only after the tool finished.
+        Args:
+            limit (int): The maximal number of tools running at once. Detected from the CPU limits if omitted.
+            timeout (float): The default timeout of a call in seconds. Omitting waits forever.
+        Returns:
+            None
+        """
+        self.limit = limit or rs.detect_cpus()
+        self.timeout = timeout
+        self.calls = []
+        # threads streaming stdin, stdout and extra channels block on their pipes, so a running call may need several
+        self._threads = concurrent.futures.ThreadPoolExecutor(max_workers=4 * self.limit, thread_name_prefix="tools")
+        self._loop = asyncio.new_event_loop()
+        self._semaphore = asyncio.Semaphore(self.limit)
+        self._thread = threading.Thread(target=self._loop.run_forever, name="tools-loop", daemon=True)
+        self._thread.start()
+    #}}}
+
+    def close( #{{{
+        self
+    ) -> None:
+        """
+        Stop the event loop and the helper threads. Safe to call more than once.
+        Args:
+            None
+        Returns:
+            None
+        """
+        if self._loop.is_closed():
+            return
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._threads.shutdown(wait=False)
+    #}}}
+
+    def submit( #{{{
+        self,
+        command: List[Union[str, Channel]],
+        stdin: Union[None, bytes, Feed] = None,
+        stdout: Optional[Consume] = None,
+        channels: List[Consume] = [],
+        cwd: Optional[str] = None,
+        timeout: Optional[float] = None,
+        name: Optional[str] = None,
+        echo: bool = False
+    ) -> concurrent.futures.Future:
+        """
+        Start an external tool without waiting for it.
+        Args:
+            command (List[str | Channel]): The command and its arguments, with a Channel per extra output.
+            stdin (bytes | Callable): The input, either as bytes or as a callable writing it to a binary file (e.g. Fasta.write_to). Omitting closes stdin.
+            stdout (Callable): A callable reading the output from a binary file while the tool runs (e.g. Fasta.read); its return value is the result. Omitting collects the output as bytes.
+            channels (List[Callable]): Callables reading further outputs like <stdout>, one per Channel placeholder in <command>. Defaults to none.
+            cwd (str): The working directory of the tool. Defaults to the current one. A relative executable path is still resolved against the current directory.
+            timeout (float): The timeout in seconds. Defaults to the timeout of the runner.
+            name (str): The name of the call in the timing records. Defaults to the executable.
+            echo (bool): Whether to pass stdout and stderr through to the terminal instead of capturing them. Defaults to False.
+        Returns:
+            Future: Resolves to the result of <stdout> or the collected output (empty if <echo>), followed by the results of <channels> as tuple if there are any. Raises ToolError if the tool fails or times out.
+        """
+        if cwd is not None and os.sep in command[0]:
+            command = [os.path.abspath(command[0]), *command[1:]]
+        coroutine = self._run(
+            command,
+            stdin = stdin,
+            stdout = stdout,
+            channels = channels,
+            cwd = cwd,
+            timeout = self.timeout if timeout is None else timeout,
+            name = name or os.path.basename(command[0]),
+            echo = echo
+        )
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+    #}}}
+
+    def run( #{{{
+        self,
+        command: List[Union[str, Channel]],
+        **kwargs
+    ) -> Any:
+        """
+        Run an external tool and wait for its result. Takes the same arguments as <submit>.
+        Args:
+            command (List[str | Channel]): The command and its arguments.
+        Returns:
+            Any: The result of the <stdout> callable or the collected output.
+        Raises:
+            ToolError: If the tool fails or times out.
+        """
+        return self.submit(command, **kwargs).result()
+    #}}}
+
+    async def _run( #{{{
+        self,
+        command: List[Union[str, Channel]],
+        stdin: Union[None, bytes, Feed],
+        stdout: Optional[Consume],
+        channels: List[Consume],
+        cwd: Optional[str],
+        timeout: Optional[float],
+        name: str,
+        echo: bool
+    ) -> Any:
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            start = time.time()
+            # (fd of the tool, fd of the helper thread) per pipe
+            feed = os.pipe() if callable(stdin) else None
+            output = os.pipe()[::-1] if stdout is not None else None
+            extra = [os.pipe()[::-1] for _ in channels]
+            pipes = [pipe for pipe in [feed, output, *extra] if pipe is not None]
+            arguments = [
+                f"{argument.prefix}/dev/fd/{extra[argument.index][0]}" if isinstance(argument, Channel) else argument
+                for argument in command
+            ]
+            try:
+                process = await asyncio.create_subprocess_exec(
+                    *arguments,
+                    cwd = cwd,
+                    stdin = feed[0] if feed else (asyncio.subprocess.DEVNULL if stdin is None else asyncio.subprocess.PIPE),
+                    stdout = output[0] if output else (None if echo else asyncio.subprocess.PIPE),
+                    stderr = None if echo else asyncio.subprocess.PIPE,
+                    pass_fds = [pipe[0] for pipe in extra]
+                )
+            except BaseException:
+                for pipe in pipes:
+                    os.close(pipe[0])
+                    os.close(pipe[1])
+                raise
+            # the other ends of the pipes now belong to the tool
+            for pipe in pipes:
+                os.close(pipe[0])
+            helpers = []
+            if feed:
+                helpers.append(loop.run_in_executor(self._threads, _feed, stdin, feed[1]))
+            if output:
+                helpers.append(loop.run_in_executor(self._threads, _consume, stdout, output[1]))
+            for consume, pipe in zip(channels, extra):
+                helpers.append(loop.run_in_executor(self._threads, _consume, consume, pipe[1]))
+            communicate = process.communicate(None if feed else stdin)
+            try:
+                (collected, errors), *results = await asyncio.wait_for(asyncio.gather(communicate, *helpers), timeout)
+            except asyncio.TimeoutError:
+                await _kill(process)
+                self.calls.append(Call(name, arguments, time.time() - start, None))
+                raise ToolError(arguments, None, reason=f"timed out after {timeout}s") from None
+            except BaseException:
+                await _kill(process)
+                raise
+            self.calls.append(Call(name, arguments, time.time() - start, process.returncode))
+            if process.returncode != 0:
+                raise ToolError(arguments, process.returncode, errors or b"")
+            if feed:
+                results = results[1:]
+            result = results[0] if output else (collected or b"")
+            return (result, *results[1 if output else 0:]) if channels else result
+    #}}}
+
+    def report( #{{{
+        self
+    ) -> Dict[str, List[float]]:
+        """
+        Summarise the timing records per tool.
+        Args:
+            None
+        Returns:
+            Dict[str, List[float]]: The number of calls, the total and the longest time in seconds per tool name.
+        """
+        summary = {}
+        for call in list(self.calls):
+            calls, total, longest = summary.get(call.name, [0, 0.0, 0.0])
+            summary[call.name] = [calls + 1, total + call.seconds, max(longest, call.seconds)]
+        return summary
+    #}}}
+#}}}
+
+def _feed( #{{{
+    feed: Feed,
+    fd: int
+) -> None:
+    try:
+        with open(fd, "wb", buffering=1 << 16) as handle:
+            feed(handle)
+    except BrokenPipeError:
+        # the tool exited without reading everything, its exit code tells why
+        pass
+#}}}
+
+def _consume( #{{{
+    consume: Consume,
+    fd: int
+) -> Any:
+    with open(fd, "rb") as handle:
+        return consume(handle)
+#}}}
+
+async def _kill( #{{{
+    process: asyncio.subprocess.Process
+) -> None:
+    if process.returncode is None:
+        process.kill()
+        await process.wait()
+#}}}
+
+_current: Optional[Runner] = None
+_lock = threading.Lock()
+
+def configure( #{{{
+    limit: Optional[int] = None,
+    timeout: Optional[float] = None
+) -> Runner:
+    """
+    Set up the tool runner of the current run. Replaces (and stops) the previous one.
+    Args:
+        limit (int): The maximal number of tools running at once. Detected from the CPU limits if omitted.
+        timeout (float): The default timeout of a call in seconds. Omitting waits forever.
+    Returns:
+        Runner: The runner of the run.
+    """
+    global _current
+    with _lock:
+        if _current is not None:
+            _current.close()
+        _current = Runner(limit=limit, timeout=timeout)
+        return _current
+#}}}
+
+def current( #{{{
+) -> Runner:
+    """
+    Get the tool runner of the current run, creating one with defaults if none was configured.
+    Args:
+        None
+    Returns:
+        Runner: The runner of the run.
+    """
+    global _current
+    with _lock:
+        if _current is None:
+            _current = Runner()
+        return _current
+#}}}
+
+def run( #{{{
+    command: List[str],
+    **kwargs
+) -> Any:
+    """
+    Run an external tool with the current runner (see Runner.run).
+    """
+    return current().run(command, **kwargs)
+#}}}
+
+def submit( #{{{
+    command: List[str],
+    **kwargs
+) -> concurrent.futures.Future:
+    """
+    Start an external tool with the current runner without waiting for it (see Runner.submit).
+    """
+    return current().submit(command, **kwargs)
+#}}}
+
+@atexit.register
+def _cleanup( #{{{
+) -> None:
+    if _current is not None:
+        _current.close()
+#}}}
@@ -0,0 +1,179 @@
+# vim: set foldmethod=marker:
+# vim: set foldclose=all foldlevel=0:
+# vim: set foldenable:
+
+from __future__ import annotations
+from typing import List, Tuple, Set, FrozenSet
+
+import numpy as np
+
+class Tree: #{{{
+    labels: List[str]
+    parent: np.ndarray
+    length: np.ndarray
+    distances: bool
+
+    def __init__( #{{{
+        self,
+        labels: List[str],
+        parent: np.ndarray,
+        length: np.ndarray,
+        distances: bool = False
+    ) -> None:
+        """
+        Create a Tree object, a tree stored as arrays instead of nested strings.
+        Nodes are numbered: the leaves 0 to n-1 (in the order of <labels>), then the inner nodes. Children are ordered by their number, and Newick is only written on request (see <newick>).
+        Args:
+            labels (List[str]): The labels of the leaves.
+            parent (np.ndarray): The parent of every node, -1 for the root.
+            length (np.ndarray): The length of the branch from every node to its parent (ignored for the root).
+            distances (bool): Whether <newick> includes branch lengths by default. Defaults to False.
+        Returns:
+            None
+        Raises:
+            ValueError: If the arrays do not match or the tree has not exactly one root.
+        """
+        parent = np.asarray(parent, dtype=np.int64)
+        length = np.asarray(length, dtype=np.float64)
+        if len(parent) != len(length) or len(parent) < len(labels):
+            raise ValueError("parent and length need one entry per node.")
+        if np.count_nonzero(parent < 0) != 1:
+            raise ValueError("A tree needs exactly one root.")
+        self.labels = labels
+        self.parent = parent
+        self.length = length
+        self.distances = distances
+    #}}}
+
+    @classmethod
+    def from_merges( #{{{
+        cls,
+        labels: List[str],
+        heights: np.ndarray,
+        first: np.ndarray,
+        second: np.ndarray,
+        distances: bool = False
+    ) -> Tree:
+        """
+        Create an ultrametric tree from the merges of a hierarchical clustering (see Distmat.merges).
+        Merge k creates node n+k at half the distance of the joined clusters, every branch spans the height difference of its ends.
+        Args:
+            labels (List[str]): The labels of the leaves.
+            heights (np.ndarray): The distance of the joined clusters per merge.
+            first (np.ndarray): The first joined node per merge.
+            second (np.ndarray): The second joined node per merge.
+            distances (bool): Whether <newick> includes branch lengths by default. Defaults to False.
+        Returns:
+            Tree: The tree.
+        """
+        leaves = len(labels)
+        nodes = leaves + len(heights)
+        parent = np.full(nodes, -1, dtype=np.int64)
+        height = np.zeros(nodes)
+        height[leaves:] = np.asarray(heights, dtype=np.float64) / 2
+        created = np.arange(leaves, nodes)
+        parent[first] = created
+        parent[second] = created
+        length = np.zeros(nodes)
+        inner = parent >= 0
+        length[inner] = height[parent[inner]] - height[inner]
+        return cls(labels, parent, length, distances=distances)
+    #}}}
+
+    def __len__( #{{{
+        self
+    ) -> int:
+        return len(self.labels)
+    #}}}
+
+    def __str__( #{{{
+        self
+    ) -> str:
+        return self.newick()
+    #}}}
+
+    @property
+    def root( #{{{
+        self
+    ) -> int:
+        return int(np.flatnonzero(self.parent < 0)[0])
+    #}}}
+
+    def children( #{{{
+        self
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Get the children of all nodes in compressed form.
+        Args:
+            None
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: Offsets and child nodes; the children of node i are nodes[offsets[i]:offsets[i+1]], ordered by number.
+        """
+        order = np.argsort(self.parent, kind="stable")
+        order = order[self.parent[order] >= 0]
+        counts = np.bincount(self.parent[order], minlength=len(self.parent))
+        offsets = np.zeros(len(self.parent) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return offsets, order
+    #}}}
+
+    def splits( #{{{
+        self
+    ) -> Set[FrozenSet[str]]:
+        """
+        Get the splits of the tree, the bipartitions of the leaves by its inner branches. Trees with the same splits have the same unrooted topology.
+        Args:
+            None
+        Returns:
+            Set[FrozenSet[str]]: Per inner branch the labels on the side without the first leaf.
+        """
+        leaves = len(self.labels)
+        offsets, nodes = self.children()
+        # breadth-first order, so every node comes after its parent
+        order = [self.root]
+        for node in order:
+            order.extend(nodes[offsets[node]:offsets[node + 1]].tolist())
+        below = [frozenset([label]) for label in self.labels] + [frozenset()] * (len(self.parent) - leaves)
+        for node in reversed(order[1:]):
+            below[self.parent[node]] = below[self.parent[node]] | below[node]
+        everything = below[self.root]
+        result = set()
+        for node in order[1:]:
+            if node >= leaves and 1 < len(below[node]) < leaves - 1:
+                result.add(everything - below[node] if self.labels[0] in below[node] else below[node])
+        return result
+    #}}}
+
+    def newick( #{{{
+        self,
+        distances: bool = None
+    ) -> str:
+        """
+        Write the tree in Newick format (without the trailing ';', like the original trees).
+        Args:
+            distances (bool): Whether to include branch lengths. Defaults to the <distances> attribute.
+        Returns:
+            str: The tree in Newick format.
+        """
+        distances = self.distances if distances is None else distances
+        leaves = len(self.labels)
+        offsets, nodes = self.children()
+        offsets, nodes, length = offsets.tolist(), nodes.tolist(), self.length.tolist()
+        root = self.root
+        parts = []
+        # iterative depth-first walk, the tree can be much deeper than the recursion limit
+        stack = [[root, 0]]
+        while stack:
+            node, index = stack[-1]
+            if node >= leaves and offsets[node] + index < offsets[node + 1]:
+                parts.append("," if index else "(")
+                stack[-1][1] += 1
+                stack.append([nodes[offsets[node] + index], 0])
+                continue
+            parts.append(self.labels[node] if node < leaves else ")")
+            if distances and node != root:
+                parts.append(f":{length[node]}")
+            stack.pop()
+        return "".join(parts)
+    #}}}
+#}}}
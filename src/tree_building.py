@@ -0,0 +1,138 @@
+# vim: set foldmethod=marker:
+# vim: set foldclose=all foldlevel=0:
+# vim: set foldenable:
+
+from typing import List, Optional, Tuple
+import concurrent.futures
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import fasta as fs
+import resources as rs
+import tree as tr
+
+# the distance matrices of all clusters, attached once per worker process (see <_attach>)
+_shared: Optional[shared_memory.SharedMemory] = None
+_matrices: Optional[np.ndarray] = None
+
+def tree_cost( #{{{
+    size: int,
+    method: str = "upgma"
+) -> float:
+    """
+    Predict the relative cost of building a tree.
+    UPGMA (nearest-neighbour chain) grows with size², neighbour joining with up to size³.
+    Args:
+        size (int): The number of sequences.
+        method (str): The tree method (see Distmat.tree). Defaults to 'upgma'.
+    Returns:
+        float: The cost in arbitrary units (comparable between trees of one method only).
+    """
+    return float(size) ** (3 if method == "nj" else 2)
+#}}}
+
+def plan_chunks( #{{{
+    sizes: List[int],
+    method: str = "upgma",
+    workers: int = 1,
+    chunks_per_worker: int = 4
+) -> List[List[int]]:
+    """
+    Group trees into chunks of similar cost, one task per chunk.
+    Trees are taken longest predicted first (see <tree_cost>), so large trees get chunks of their own and start early, while thousands of tiny trees share a few chunks.
+    Args:
+        sizes (List[int]): The number of sequences per tree.
+        method (str): The tree method. Defaults to 'upgma'.
+        workers (int): The number of worker processes. Defaults to 1.
+        chunks_per_worker (int): The number of chunks to aim for per worker, more balance the load better. Defaults to 4.
+    Returns:
+        List[List[int]]: The indices of the trees per chunk, in submission order.
+    """
+    costs = [tree_cost(size, method) for size in sizes]
+    target = sum(costs) / max(workers * chunks_per_worker, 1)
+    chunks, chunk, cost = [], [], 0.0
+    for index in sorted(range(len(sizes)), key=lambda index: costs[index], reverse=True):
+        chunk.append(index)
+        cost += costs[index]
+        if cost >= target:
+            chunks.append(chunk)
+            chunk, cost = [], 0.0
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+#}}}
+
+def build_trees( #{{{
+    distmats: List[fs.Distmat],
+    method: str = "upgma",
+    workers: Optional[int] = None,
+    chunks_per_worker: int = 4,
+    serial_below: int = 100_000
+) -> List[tr.Tree]:
+    """
+    Build the trees of many clusters (see Distmat.tree) in a pool of processes.
+    The condensed matrices are copied once into a shared memory block that the workers map, so only offsets travel to them and only the parent and length arrays travel back.
+    Tasks are chunks of trees (see <plan_chunks>), which keeps the overhead per task low for the many tiny clusters.
+    Args:
+        distmats (List[Distmat]): The distance matrices of the clusters.
+        method (str): Either 'upgma' or 'nj'. Defaults to 'upgma'.
+        workers (int): The number of worker processes. Detected from the CPU limits if omitted. One builds the trees in this process.
+        chunks_per_worker (int): The number of chunks to aim for per worker. Defaults to 4.
+        serial_below (int): Below this number of distances in all matrices together, starting the processes costs more than it saves and the trees are built in this process. Defaults to 100,000.
+    Returns:
+        List[Tree]: The trees, in input order.
+    Raises:
+        ValueError: If <method> is unknown.
+    """
+    if method not in ("upgma", "nj"):
+        raise ValueError(f"Valid tree methods: upgma, nj (provided: {method})")
+    workers = workers or rs.detect_cpus()
+    sizes = [distmat.size for distmat in distmats]
+    total = sum(size * (size - 1) // 2 for size in sizes)
+    if workers <= 1 or len(distmats) <= 1 or total < max(serial_below, 1):
+        return [distmat.tree(method=method) for distmat in distmats]
+    chunks = plan_chunks(sizes, method, workers, chunks_per_worker)
+    offsets = np.zeros(len(distmats) + 1, dtype=np.int64)
+    np.cumsum([size * (size - 1) // 2 for size in sizes], out=offsets[1:])
+    shared = shared_memory.SharedMemory(create=True, size=total * 8)
+    try:
+        matrices = np.ndarray((total,), dtype=np.float64, buffer=shared.buf)
+        for index, distmat in enumerate(distmats):
+            matrices[offsets[index]:offsets[index + 1]] = distmat.condensed
+        del matrices
+        results = [None] * len(distmats)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(workers, len(chunks)), initializer=_attach, initargs=(shared.name,)) as executor:
+            futures = [
+                executor.submit(_build_chunk, [(int(offsets[index]), sizes[index]) for index in chunk], method)
+                for chunk in chunks
+            ]
+            for chunk, future in zip(chunks, futures):
+                for index, (parent, length) in zip(chunk, future.result()):
+                    results[index] = tr.Tree(distmats[index].labels[:], parent, length)
+    finally:
+        shared.close()
+        shared.unlink()
+    return results
+#}}}
+
+def _attach( #{{{
+    name: str
+) -> None:
+    global _shared, _matrices
+    # the workers share the resource tracker of the parent, which unlinks the block when the stage ends
+    _shared = shared_memory.SharedMemory(name=name)
+    _matrices = np.ndarray((_shared.size // 8,), dtype=np.float64, buffer=_shared.buf)
+#}}}
+
+def _build_chunk( #{{{
+    tasks: List[Tuple[int, int]],
+    method: str
+) -> List[Tuple[np.ndarray, np.ndarray]]:
+    results = []
+    for offset, size in tasks:
+        condensed = _matrices[offset:offset + size * (size - 1) // 2]
+        tree = fs.Distmat.from_condensed(condensed, labels=[""] * size).tree(method=method)
+        results.append((tree.parent, tree.length))
+    return results
+#}}}
@@ -0,0 +1,165 @@
+# vim: set foldmethod=marker:
+# vim: set foldclose=all foldlevel=0:
+# vim: set foldenable:
+
+from __future__ import annotations
+from typing import Optional
+import atexit
+import os
+import shutil
+import tempfile
+
+class Job: #{{{
+    path: str
+    keep: bool
+
+    def __init__( #{{{
+        self,
+        parent: str,
+        name: str = "job",
+        keep: bool = False
+    ) -> None:
+        """
+        Create a Job object owning a fresh, unique scratch directory.
+        Use it as a context manager (or call <close>) to remove the directory afterwards, also when the job fails.
+        Args:
+            parent (str): The directory to create the scratch directory in.
+            name (str): A prefix for the directory name to recognise the job. Defaults to 'job'.
+            keep (bool): Whether to keep the files after closing for debugging. Defaults to False.
+        Returns:
+            None
+        """
+        self.path = os.path.abspath(tempfile.mkdtemp(prefix=f"{name}-", dir=parent))
+        self.keep = keep
+    #}}}
+
+    def __enter__( #{{{
+        self
+    ) -> Job:
+        return self
+    #}}}
+
+    def __exit__( #{{{
+        self,
+        *_
+    ) -> None:
+        self.close()
+    #}}}
+
+    def file( #{{{
+        self,
+        filename: str
+    ) -> str:
+        """
+        Get the path of a file inside the scratch directory.
+        Args:
+            filename (str): The name of the file.
+        Returns:
+            str: The full path.
+        """
+        return os.path.join(self.path, filename)
+    #}}}
+
+    def close( #{{{
+        self
+    ) -> None:
+        """
+        Remove the scratch directory unless <keep> is set. Safe to call more than once.
+        Args:
+            None
+        Returns:
+            None
+        """
+        if not self.keep:
+            shutil.rmtree(self.path, ignore_errors=True)
+    #}}}
+#}}}
+
+class Workdir(Job): #{{{
+    def __init__( #{{{
+        self,
+        base: Optional[str] = None,
+        keep: bool = False
+    ) -> None:
+        """
+        Create a Workdir object, the unique scratch directory of one pipeline run.
+        Every external tool call gets its own job directory below it (see <job>).
+        Args:
+            base (str): The directory to place the run in, e.g. a local disk or '/dev/shm'. Omitting uses the system temp directory ($TMPDIR).
+            keep (bool): Whether to keep all files after the run for debugging. Defaults to False.
+        Returns:
+            None
+        """
+        if base is not None:
+            os.makedirs(base, exist_ok=True)
+        super().__init__(parent=base, name="mag-genetree", keep=keep)
+    #}}}
+
+    def job( #{{{
+        self,
+        name: str = "job"
+    ) -> Job:
+        """
+        Create a unique job directory inside this run.
+        Args:
+            name (str): A prefix for the directory name (e.g. 'diamond'). Defaults to 'job'.
+        Returns:
+            Job: The new job, to be used as context manager.
+        """
+        return Job(self.path, name=name, keep=self.keep)
+    #}}}
+#}}}
+
+_current: Optional[Workdir] = None
+
+def configure( #{{{
+    base: Optional[str] = None,
+    keep: bool = False
+) -> Workdir:
+    """
+    Set up the work directory of the current run. Replaces (and cleans) the previous one.
+    The directory is removed at interpreter exit unless <keep> is set.
+    Args:
+        base (str): The directory to place the run in. Omitting uses the system temp directory.
+        keep (bool): Whether to keep all files for debugging. Defaults to False.
+    Returns:
+        Workdir: The work directory of the run.
+    """
+    global _current
+    if _current is not None:
+        _current.close()
+    _current = Workdir(base=base, keep=keep)
+    return _current
+#}}}
+
+def current( #{{{
+) -> Workdir:
+    """
+    Get the work directory of the current run, creating one with defaults if none was configured.
+    Args:
+        None
+    Returns:
+        Workdir: The work directory of the run.
+    """
+    return _current if _current is not None else configure()
+#}}}
+
+def job( #{{{
+    name: str = "job"
+) -> Job:
+    """
+    Create a unique job directory inside the current run (see Workdir.job).
+    Args:
+        name (str): A prefix for the directory name. Defaults to 'job'.
+    Returns:
+        Job: The new job, to be used as context manager.
+    """
+    return current().job(name)
+#}}}
+
+@atexit.register
+def _cleanup( #{{{
+) -> None:
+    if _current is not None:
+        _current.close()
+#}}}